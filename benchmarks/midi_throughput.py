@@ -0,0 +1,241 @@
+"""
+Parse/write throughput benchmarks for voicetrainer.midi.
+
+Generates synthetic standard midi files and times MidiFile.readstr,
+MidiTrack.read, MidiTrack.get_bytes and MidiFile.writestr on them.
+Writes encode all events, except for clean_write, which copies the
+chunks of unchanged tracks as read; running_write uses running status.
+Results are written as json, so runs from different commits can be
+compared with --compare:
+
+    python benchmarks/midi_throughput.py --output before.json
+    git checkout other-branch
+    python benchmarks/midi_throughput.py --output after.json --compare before.json
+"""
+import argparse
+import gc
+import json
+import platform
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from voicetrainer.midi import MidiFile, MidiTrack
+
+# larger files, like --events 1000000, are opt-in: they take long under tracemalloc
+DEFAULT_EVENTS = (1000, 10000, 100000)
+DEFAULT_TRACKS = (1, 4, 32)
+
+def variable_length(num: int) -> bytes:
+    """Encode num as a midi variable length number."""
+    out = [num & 0x7F]
+    num >>= 7
+    while num:
+        out.append((num & 0x7F) | 0x80)
+        num >>= 7
+    return bytes(reversed(out))
+
+def synthetic_track(index: int, num_events: int, running_status: bool) -> bytes:
+    """
+    Track with a name, alternating note on/off events and an end.
+
+    With running_status note offs are note ons with velocity 0, so the
+    status byte repeats and is left out.
+    """
+    channel = index % 16
+    name = "track{}:".format(index).encode('ascii')
+    body = bytearray(b'\x00\xff\x03' + variable_length(len(name)) + name)
+    last_status = None
+    for i in range(num_events):
+        pitch = 36 + (i // 2) % 48
+        if i % 2 == 0:
+            status, velocity, delta = 0x90 | channel, 64 + i % 63, 0 if i % 8 else 96
+        elif running_status:
+            status, velocity, delta = 0x90 | channel, 0, 48
+        else:
+            status, velocity, delta = 0x80 | channel, 64, 48
+        body += variable_length(delta)
+        if not running_status or status != last_status:
+            body.append(status)
+        body += bytes([pitch, velocity])
+        last_status = status
+    body += b'\x00\xff\x2f\x00'
+    return b'MTrk' + struct.pack('>I', len(body)) + bytes(body)
+
+def synthetic_midi(num_events: int, num_tracks: int, running_status: bool) -> bytes:
+    """Format 1 file with num_events note events spread over num_tracks."""
+    per_track = max(num_events // num_tracks, 1)
+    return b'MThd' + struct.pack('>IHHH', 6, 1, num_tracks, 384) + b''.join(
+        synthetic_track(i, per_track, running_status) for i in range(num_tracks))
+
+def measure(operation: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """
+    Best wall time of repeat runs, then memory of one more run.
+
+    peak_bytes is the traced peak during the run, live_blocks the number
+    of blocks the run allocated that are still alive when it returns (its
+    result included), retained_blocks how many of those outlive the
+    result. Neither counts blocks that were allocated and freed again.
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    result = operation()
+    # only allocations made since start() are traced
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    live = sum(stat.count for stat in snapshot.statistics('filename'))
+    del snapshot
+    del result
+    gc.collect()
+    retained = sys.getallocatedblocks() - blocks
+    return {
+        'seconds': best, 'peak_bytes': peak,
+        'live_blocks': live, 'retained_blocks': retained}
+
+def first_track(midi_str: bytes) -> bytes:
+    """Bytes of the first track chunk."""
+    length = struct.unpack('>I', midi_str[18:22])[0]
+    return midi_str[14:22 + length]
+
+def readstr(midi_str: bytes) -> MidiFile:
+    """Parse a whole file."""
+    midi = MidiFile()
+    midi.readstr(midi_str)
+    return midi
+
+def read_track(track_str: bytes) -> MidiTrack:
+    """Parse a single track chunk."""
+    track = MidiTrack(0)
+    track.read(track_str)
+    return track
+
+def encode_all(midi: MidiFile) -> MidiFile:
+    """Mark all tracks dirty, so writing encodes every event."""
+    for track in midi.tracks:
+        track.dirty = True
+    return midi
+
+def run_case(num_events: int, num_tracks: int, running_status: bool, repeat: int) -> List[Dict]:
+    """Benchmark all operations on one synthetic file."""
+    midi_str = synthetic_midi(num_events, num_tracks, running_status)
+    parsed = readstr(midi_str)
+    dirty = encode_all(readstr(midi_str))
+    track_str = first_track(midi_str)
+    track = read_track(track_str)
+    track.dirty = True
+    operations = {
+        'read': lambda: readstr(midi_str),
+        'write': dirty.writestr,
+        'clean_write': parsed.writestr,
+        'running_write': lambda: dirty.writestr(running_status=True),
+        'roundtrip': lambda: encode_all(readstr(midi_str)).writestr(),
+        'track_read': lambda: read_track(track_str),
+        'track_write': track.get_bytes}
+    events = {
+        'read': num_events,
+        'write': num_events,
+        'clean_write': num_events,
+        'running_write': num_events,
+        'roundtrip': num_events,
+        'track_read': len(track.events) // 2,
+        'track_write': len(track.events) // 2}
+    results = []
+    for name, operation in operations.items():
+        result = measure(operation, repeat)
+        result.update({
+            'operation': name,
+            'events': num_events,
+            'tracks': num_tracks,
+            'running_status': running_status,
+            'bytes': len(midi_str),
+            'events_per_second': events[name] / result['seconds']})
+        results.append(result)
+        print(
+            "{operation:>12} {events:>8} events {tracks:>3} tracks "
+            "running_status={running_status!s:<5} "
+            "{events_per_second:>12.0f} events/s {peak_bytes:>12} B peak "
+            "{live_blocks:>9} live {retained_blocks:>9} retained".format(**result))
+    return results
+
+def git_commit() -> str:
+    """Commit of the working tree, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=str(Path(__file__).resolve().parent),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: List[Dict], baseline_path: str, threshold: float) -> int:
+    """Print speed ratios against a previous run, return number of regressions."""
+    baseline = json.loads(Path(baseline_path).read_text())
+    def key(result):
+        return (
+            result['operation'], result['events'],
+            result['tracks'], result['running_status'])
+    previous = {key(result): result for result in baseline['results']}
+    regressions = 0
+    print("\ncompared to {} ({})".format(baseline_path, baseline.get('commit')))
+    for result in results:
+        if key(result) not in previous:
+            continue
+        ratio = result['events_per_second'] / previous[key(result)]['events_per_second']
+        slower = ratio < 1 - threshold
+        regressions += slower
+        print("{:>12} {:>8} events {:>3} tracks running_status={!s:<5} {:6.2f}x{}".format(
+            *key(result), ratio, "  REGRESSION" if slower else ""))
+    return regressions
+
+def main() -> None:
+    """Run the benchmark matrix."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--events', type=int, nargs='+', default=DEFAULT_EVENTS,
+        help="total note events per file")
+    parser.add_argument(
+        '--tracks', type=int, nargs='+', default=DEFAULT_TRACKS,
+        help="number of tracks per file")
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="timing runs per operation, the best one is kept")
+    parser.add_argument('--output', help="write results to this json file")
+    parser.add_argument('--compare', help="json file of an earlier run")
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    results = []
+    for num_events in args.events:
+        for num_tracks in args.tracks:
+            for running_status in (False, True):
+                results.extend(run_case(
+                    num_events, num_tracks, running_status, args.repeat))
+    if args.output:
+        Path(args.output).write_text(json.dumps({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results}, indent=2))
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
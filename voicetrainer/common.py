@@ -1,8 +1,23 @@
 """Stuff that I didn't know a better place for."""
 from itertools import product
+import re
 
 PITCH_LIST = tuple((note + octave for octave, note in product(
     (',', '', '\''),
     tuple("cdefgab"))))
 
 SOUND_LIST = ("Mi", "Na", "Noe", "Nu", "No")
+
+_NOTE_SEMITONES = {'c': 0, 'd': 2, 'e': 4, 'f': 5, 'g': 7, 'a': 9, 'b': 11}
+_LILY_PITCH = re.compile(r"([a-g])((?:is|es|s)*)([,']*)$")
+
+def get_semitones(pitch: str) -> int:
+    """Semitones of lilypond pitch above c, or None if it is not a pitch."""
+    match = _LILY_PITCH.match(pitch)
+    if match is None:
+        return None
+    note, accidentals, octaves = match.groups()
+    sharps = accidentals.count('is')
+    flats = accidentals.count('s') - sharps
+    return _NOTE_SEMITONES[note] + sharps - flats + \
+        12 * (octaves.count('\'') - octaves.count(','))
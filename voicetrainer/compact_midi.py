@@ -0,0 +1,591 @@
+"""Array backed (struct-of-arrays) representation of midi files."""
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+
+from voicetrainer.midi import (
+    MidiFile, MidiTrack, MidiEvent, DeltaTime, MidiException,
+    CHANNEL_VOICE_MESSAGES, CHANNEL_MODE_MESSAGES, META_EVENTS,
+    pair_notes, put_number, scale_tempo_data, transpose_error, transpose_table,
+    write_variable_length_number)
+
+SYSEX_EVENTS = {"F0_SYSEX_EVENT": 0xF0, "F7_SYSEX_EVENT": 0xF7}
+_SYSEX_TYPES = {value: type_ for type_, value in SYSEX_EVENTS.items()}
+_ONE_DATA_BYTE = ("PROGRAM_CHANGE", "CHANNEL_KEY_PRESSURE")
+
+# translation tables indexed by status byte: 1 for rows a transform
+# applies to, 0 for all others
+_NOTE_ROWS = bytes(
+    1 if 0x80 <= status < 0xA0 else 0 for status in range(256))
+_PITCHED_NOTE_ROWS = bytes(
+    1 if 0x80 <= status < 0xA0 and status & 0x0F != 9 else 0
+    for status in range(256))
+_SEVEN_BITS = bytes(value & 0x7F for value in range(256))
+_SET_TEMPO = META_EVENTS.SET_TEMPO
+_TIME_SIGNATURE = META_EVENTS.TIME_SIGNATURE
+
+# binary cache layout: header, time signature table, then per track a
+# header followed by the column arrays and the payload, see
+# CompactMidiFile.dumps()
+CACHE_SUFFIX = '.cache'
+PARTIAL_SUFFIX = '.partial'
+_CACHE_MAGIC = b'VTMC'
+_CACHE_VERSION = 1
+_CACHE_HEADER = struct.Struct('<4sHBBQqHHHI')
+_CACHE_COUNT = struct.Struct('<I')
+_CACHE_TRACK_HEADER = struct.Struct('<III')
+# ticks and payload offsets are stored as 32 bit, not as 'L' which is
+# 64 bit on most platforms
+_CACHE_LONG = 'I'
+_LONG_SIZE = array(_CACHE_LONG).itemsize
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+def _clamp(value: int) -> int:
+    return min(max(value, 0), 127)
+
+def _masked_translate(
+        mask_table: bytes,
+        status: array,
+        column: array,
+        table: bytes) -> array:
+    """
+    Map column through table, but only for rows selected by mask_table.
+
+    Runs as a few whole-column operations instead of a loop: the 0/1
+    row mask is shifted into the high bit of every (7 bit) data byte,
+    so the first half of table sees unselected rows and the second
+    half selected ones.
+
+    >>> # note on, controller, drum note on, note off and a meta event
+    >>> status = array('B', [0x90, 0xB0, 0x99, 0x80, 0xFF])
+    >>> data1 = array('B', [60, 7, 36, 60, 3])
+    >>> up_two = bytes(range(128)) + bytes((value + 2) % 128 for value in range(128))
+    >>> list(_masked_translate(_NOTE_ROWS, status, data1, up_two))
+    [62, 7, 38, 62, 3]
+    >>> list(_masked_translate(_PITCHED_NOTE_ROWS, status, data1, up_two))
+    [62, 7, 36, 62, 3]
+    """
+    size = len(column)
+    mask = int.from_bytes(status.tobytes().translate(mask_table), 'big')
+    values = int.from_bytes(column.tobytes().translate(_SEVEN_BITS), 'big')
+    keys = ((mask << 7) | values).to_bytes(size, 'big')
+    return array('B', keys.translate(table))
+
+def event_to_row(event: MidiEvent) -> Tuple[int, int, int, bytes]:
+    """Encode event as (status, data1, data2, payload)."""
+    type_ = event.type_
+    if CHANNEL_VOICE_MESSAGES.hasattr(type_):
+        status = getattr(CHANNEL_VOICE_MESSAGES, type_) + event.channel - 1
+        if type_ in _ONE_DATA_BYTE:
+            return status, event.data, 0, b''
+        # pylint: disable=protected-access
+        return status, event._parameter1, event._parameter2, b''
+    if CHANNEL_MODE_MESSAGES.hasattr(type_):
+        # on the wire this is a controller change, which is
+        # also what it will be read back as
+        return (
+            0xB0 + event.channel - 1,
+            getattr(CHANNEL_MODE_MESSAGES, type_),
+            int(event.data),
+            b'')
+    if type_ in SYSEX_EVENTS:
+        return SYSEX_EVENTS[type_], 0, 0, bytes(event.data)
+    if META_EVENTS.hasattr(type_):
+        return 0xFF, getattr(META_EVENTS, type_), 0, bytes(event.data)
+    raise MidiException("cannot store midi event type_: {}".format(type_))
+
+def row_to_event(
+        track: MidiTrack,
+        status: int,
+        data1: int,
+        data2: int,
+        payload: bytes) -> MidiEvent:
+    """Decode a row into a MidiEvent, inverse of event_to_row."""
+    event = MidiEvent(track)
+    if status == 0xFF:
+        event.type_ = META_EVENTS.whatis(data1)
+        event.data = payload
+    elif status in _SYSEX_TYPES:
+        event.type_ = _SYSEX_TYPES[status]
+        event.data = payload
+    else:
+        event.type_ = CHANNEL_VOICE_MESSAGES.whatis(status & 0xF0)
+        event.channel = (status & 0x0F) + 1
+        if event.type_ in _ONE_DATA_BYTE:
+            event.data = data1
+        else:
+            # pylint: disable=protected-access
+            event._parameter1 = data1
+            event._parameter2 = data2
+    event.last_status_byte = status
+    return event
+
+def write_rows(
+        out: bytearray,
+        rows: Iterable[Tuple[int, int, int, int, bytes]],
+        running_status: bool=False) -> None:
+    """
+    Append (tick, status, data1, data2, payload) rows as an MTrk chunk.
+
+    Rows are encoded as they come, so they can be produced lazily.
+    """
+    start = len(out)
+    out.extend(b"MTrk\x00\x00\x00\x00")
+    previous_tick = 0
+    last_status = None
+    for tick, status, data1, data2, payload in rows:
+        write_variable_length_number(out, tick - previous_tick)
+        previous_tick = tick
+        if status == 0xFF or status in _SYSEX_TYPES:
+            if status == 0xFF:
+                out.append(0xFF)
+                out.append(data1)
+            else:
+                out.append(status)
+            write_variable_length_number(out, len(payload))
+            out.extend(payload)
+            last_status = None
+            continue
+        if running_status and status & 0xF0 == 0x80:
+            # note off as note on with velocity 0
+            status, data2 = status | 0x10, 0
+        if not running_status or status != last_status:
+            out.append(status)
+        last_status = status
+        out.append(data1)
+        if status & 0xF0 not in (0xC0, 0xD0):
+            out.append(data2)
+    out[start + 4:start + 8] = put_number(len(out) - start - 8, 4)
+
+class CompactTrack:
+
+    """
+    Midi track stored as parallel arrays, one entry per event.
+
+    Ticks are absolute. Meta and sysex events keep their data in the
+    shared `payload` buffer, addressed by `payload_offsets` and
+    `payload_lengths`; for meta events data1 holds the meta type.
+    """
+
+    def __init__(self, index: int=0) -> None:
+        self.index = index
+        self.ticks = array('L')
+        self.status = array('B')
+        self.data1 = array('B')
+        self.data2 = array('B')
+        self.payload_offsets = array('L')
+        self.payload_lengths = array('L')
+        self.payload = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.ticks)
+
+    def __repr__(self) -> str:
+        return "<CompactTrack {} -- {} events>".format(self.index, len(self))
+
+    def append(
+            self,
+            tick: int,
+            status: int,
+            data1: int=0,
+            data2: int=0,
+            payload: bytes=b'') -> None:
+        """Add event at absolute tick."""
+        self.ticks.append(tick)
+        self.status.append(status)
+        self.data1.append(data1)
+        self.data2.append(data2)
+        self.payload_offsets.append(len(self.payload))
+        self.payload_lengths.append(len(payload))
+        self.payload.extend(payload)
+
+    def get_payload(self, index: int) -> bytes:
+        """Return meta or sysex data of event at index."""
+        offset = self.payload_offsets[index]
+        return bytes(self.payload[offset:offset + self.payload_lengths[index]])
+
+    def rows(self, start: int=0) -> Iterator[Tuple[int, int, int, int, bytes]]:
+        """Iterate over (tick, status, data1, data2, payload), from index start on."""
+        for i in range(start, len(self)):
+            yield (
+                self.ticks[i],
+                self.status[i],
+                self.data1[i],
+                self.data2[i],
+                self.get_payload(i) if self.payload_lengths[i] else b'')
+
+    def adjust_velocities(self, offset: int=0, factor: float=1.0) -> None:
+        """
+        Scale and offset all note velocities, clamped to 0..127.
+
+        Zero velocities stay zero, so note offs keep being note offs.
+        """
+        table = bytes(range(128)) + bytes([0]) + bytes(
+            _clamp(int(round(velocity * factor)) + offset)
+            for velocity in range(1, 128))
+        self.data2 = _masked_translate(
+            _NOTE_ROWS, self.status, self.data2, table)
+
+    def transpose(self, semitones: int, skip_drums: bool=True) -> None:
+        """Shift all note pitches, leaving channel 10 alone by default."""
+        mask_table = _PITCHED_NOTE_ROWS if skip_drums else _NOTE_ROWS
+        table = bytes(range(128)) + transpose_table(semitones)
+        data1 = _masked_translate(mask_table, self.status, self.data1, table)
+        if 0xFF in data1:
+            raise transpose_error(self.data1[data1.index(0xFF)], semitones)
+        self.data1 = data1
+
+    def scale_ticks(self, factor: float) -> None:
+        """Multiply all absolute ticks by factor."""
+        self.ticks = array(
+            'L', [int(round(tick * factor)) for tick in self.ticks])
+
+    def scale_tempo(self, factor: float) -> None:
+        """Make tempo factor times faster by rewriting SET_TEMPO events."""
+        for i, status in enumerate(self.status):
+            if status != 0xFF or self.data1[i] != _SET_TEMPO or \
+                    self.payload_lengths[i] != 3:
+                continue
+            offset = self.payload_offsets[i]
+            self.payload[offset:offset + 3] = scale_tempo_data(
+                self.payload[offset:offset + 3], factor)
+
+    def time_signatures(self) -> Iterator[Tuple[int, int, int, int]]:
+        """Iterate over (tick, row, numerator, denominator as power of 2)."""
+        status = self.status.tobytes()
+        i = status.find(0xFF)
+        while i != -1:
+            if self.data1[i] == _TIME_SIGNATURE and self.payload_lengths[i] >= 2:
+                offset = self.payload_offsets[i]
+                yield (
+                    self.ticks[i], i,
+                    self.payload[offset], self.payload[offset + 1])
+            i = status.find(0xFF, i + 1)
+
+    def notes(self) -> List[Tuple[int, int, int, int, int]]:
+        """(start_tick, end_tick, channel, pitch, velocity) of all notes."""
+        status, data1, data2 = self.status, self.data1, self.data2
+        note_events = (
+            (
+                self.ticks[i],
+                status[i] >= 0x90 and data2[i] != 0,
+                (status[i] & 0x0F) + 1,
+                data1[i],
+                data2[i])
+            for i in range(len(self)) if 0x80 <= status[i] < 0xA0)
+        return pair_notes(note_events, self.ticks[-1] if len(self) else 0)
+
+    def write_to(self, out: bytearray, running_status: bool=False) -> None:
+        """
+        Append the track as an MTrk chunk to out.
+
+        Gives the same bytes as converting to a MidiTrack and writing that.
+        """
+        write_rows(out, self.rows(), running_status)
+
+    @classmethod
+    def from_midi_track(cls, track: MidiTrack) -> 'CompactTrack':
+        """Convert MidiTrack, dropping the per event objects."""
+        compact = cls(track.index)
+        tick = 0
+        for event in track.events:
+            if event.is_delta_time():
+                tick += event.time
+                continue
+            compact.append(tick, *event_to_row(event))
+        return compact
+
+    def to_midi_track(self) -> MidiTrack:
+        """Convert back into a MidiTrack with DeltaTime/MidiEvent pairs."""
+        track = MidiTrack(self.index)
+        previous_tick = 0
+        for tick, status, data1, data2, payload in self.rows():
+            track.events.append(DeltaTime(track, time=tick - previous_tick))
+            track.events.append(
+                row_to_event(track, status, data1, data2, payload))
+            previous_tick = tick
+        return track
+
+class CompactMidiFile:
+
+    """Array backed counterpart of MidiFile."""
+
+    def __init__(self) -> None:
+        self.format = 1
+        self.ticks_per_quarter_note = 1024
+        self.ticks_per_second = None
+        self.tracks = []
+        # (tick, numerator, denominator as power of 2) of all tracks,
+        # ordered like MidiFile.merged_events
+        self.time_signatures = []
+
+    def __repr__(self) -> str:
+        return "<CompactMidiFile {} tracks>".format(len(self.tracks))
+
+    @classmethod
+    def from_midi_file(cls, midi: MidiFile) -> 'CompactMidiFile':
+        """Convert parsed MidiFile."""
+        compact = cls()
+        compact.format = midi.format
+        compact.ticks_per_quarter_note = midi.ticks_per_quarter_note
+        compact.ticks_per_second = midi.ticks_per_second
+        compact.tracks = [
+            CompactTrack.from_midi_track(track) for track in midi.tracks]
+        compact.update_time_signatures()
+        return compact
+
+    def notes(self) -> List[List[Tuple[int, int, int, int, int]]]:
+        """Notes of every track, see CompactTrack.notes."""
+        return [track.notes() for track in self.tracks]
+
+    def update_time_signatures(self) -> None:
+        """Collect the time signature table from the tracks."""
+        found = []
+        for track_num, track in enumerate(self.tracks):
+            for tick, row, numerator, denominator in track.time_signatures():
+                found.append((tick, track_num, row, numerator, denominator))
+        found.sort()
+        self.time_signatures = [
+            (tick, numerator, denominator)
+            for tick, _, _, numerator, denominator in found]
+
+    def to_midi_file(self) -> MidiFile:
+        """Convert back into a MidiFile that writes identical bytes."""
+        midi = MidiFile()
+        midi.format = self.format
+        midi.ticks_per_quarter_note = self.ticks_per_quarter_note
+        midi.ticks_per_second = self.ticks_per_second
+        midi.tracks = [track.to_midi_track() for track in self.tracks]
+        return midi
+
+    def adjust_velocities(self, offset: int=0, factor: float=1.0) -> None:
+        """Scale and offset note velocities of all tracks."""
+        for track in self.tracks:
+            track.adjust_velocities(offset, factor)
+
+    def transpose(self, semitones: int, skip_drums: bool=True) -> None:
+        """Shift note pitches of all tracks."""
+        for track in self.tracks:
+            track.transpose(semitones, skip_drums)
+
+    def scale_ticks(self, factor: float) -> None:
+        """Multiply absolute ticks of all tracks by factor."""
+        for track in self.tracks:
+            track.scale_ticks(factor)
+        self.update_time_signatures()
+
+    def scale_tempo(self, factor: float) -> None:
+        """Make tempo factor times faster in all tracks."""
+        for track in self.tracks:
+            track.scale_tempo(factor)
+
+    def readstr(self, midi_str: bytes) -> None:
+        """Parse midi data and keep only the compact form."""
+        midi = MidiFile()
+        midi.readstr(midi_str)
+        parsed = self.from_midi_file(midi)
+        self.format = parsed.format
+        self.ticks_per_quarter_note = parsed.ticks_per_quarter_note
+        self.ticks_per_second = parsed.ticks_per_second
+        self.tracks = parsed.tracks
+        self.time_signatures = parsed.time_signatures
+
+    def get_header(self, num_tracks: int=None) -> bytes:
+        """MThd chunk, for num_tracks or else all tracks."""
+        if self.ticks_per_quarter_note & 0x8000:
+            raise MidiException(
+                "cannot write midi with {} ticks per quarter note".format(
+                    self.ticks_per_quarter_note))
+        return b"MThd" + struct.pack(
+            '>IHHH', 6, self.format,
+            len(self.tracks) if num_tracks is None else num_tracks,
+            self.ticks_per_quarter_note)
+
+    def writestr(self, running_status: bool=False) -> bytes:
+        """Generate midi data, straight from the arrays."""
+        out = bytearray(self.get_header())
+        for track in self.tracks:
+            track.write_to(out, running_status)
+        return bytes(out)
+
+    def dumps(self, source_size: int=0, source_mtime: int=0) -> bytes:
+        """
+        Serialize into the binary cache format.
+
+        source_size and source_mtime (in nanoseconds) identify the midi
+        file this was parsed from, see load_cached_midi.
+        """
+        out = bytearray(_CACHE_HEADER.pack(
+            _CACHE_MAGIC, _CACHE_VERSION, _LONG_SIZE, _LITTLE_ENDIAN,
+            source_size, source_mtime, self.format,
+            self.ticks_per_quarter_note, self.ticks_per_second or 0,
+            len(self.tracks)))
+        out.extend(_CACHE_COUNT.pack(len(self.time_signatures)))
+        out.extend(array(_CACHE_LONG, [
+            tick for tick, _, _ in self.time_signatures]).tobytes())
+        out.extend(bytes(
+            numerator for _, numerator, _ in self.time_signatures))
+        out.extend(bytes(
+            denominator for _, _, denominator in self.time_signatures))
+        for track in self.tracks:
+            out.extend(_CACHE_TRACK_HEADER.pack(
+                track.index, len(track), len(track.payload)))
+            for column in (
+                    track.ticks, track.status, track.data1, track.data2,
+                    track.payload_offsets, track.payload_lengths):
+                if column.typecode == 'L':
+                    column = array(_CACHE_LONG, column)
+                out.extend(column.tobytes())
+            out.extend(track.payload)
+        return bytes(out)
+
+    @classmethod
+    def loads(
+            cls,
+            data: bytes,
+            source_size: int=None,
+            source_mtime: int=None) -> 'CompactMidiFile':
+        """
+        Deserialize data written by dumps.
+
+        Raises MidiException if data is not a cache of this version and
+        platform, or not for a source of the given size and mtime.
+
+        >>> track = MidiTrack(0)
+        >>> signature = MidiEvent(track, type_="TIME_SIGNATURE")
+        >>> signature.data = b'\\x03\\x02\\x18\\x08'
+        >>> note = MidiEvent(track, type_="NOTE_ON", channel=1)
+        >>> note.pitch, note.velocity = 60, 100
+        >>> track.events = [
+        ...     DeltaTime(track, time=0), signature, DeltaTime(track, time=96), note]
+        >>> midi = MidiFile()
+        >>> midi.tracks.append(track)
+        >>> compact = CompactMidiFile()
+        >>> compact.readstr(midi.writestr())
+        >>> data = compact.dumps(source_size=42, source_mtime=7)
+        >>> loaded = CompactMidiFile.loads(data, 42, 7)
+        >>> loaded.time_signatures
+        [(0, 3, 2)]
+        >>> list(loaded.tracks[0].rows())
+        [(0, 255, 88, 0, b'\\x03\\x02\\x18\\x08'), (96, 144, 60, 100, b'')]
+        >>> loaded.writestr() == compact.writestr()
+        True
+        >>> CompactMidiFile.loads(data[:10])
+        Traceback (most recent call last):
+        voicetrainer.midi.MidiException: midi cache is truncated
+        >>> CompactMidiFile.loads(data[:-1])
+        Traceback (most recent call last):
+        voicetrainer.midi.MidiException: midi cache is truncated
+        >>> CompactMidiFile.loads(data, 42, 8)
+        Traceback (most recent call last):
+        voicetrainer.midi.MidiException: midi cache is out of date
+        >>> CompactMidiFile.loads(b'MThd' + data[4:])
+        Traceback (most recent call last):
+        voicetrainer.midi.MidiException: not a midi cache for this version and platform
+        """
+        buf = memoryview(data)
+        try:
+            (magic, version, long_size, little_endian, size, mtime,
+             midi_format, ticks_per_quarter_note, ticks_per_second,
+             num_tracks) = _CACHE_HEADER.unpack_from(buf, 0)
+        except struct.error:
+            # too short to unpack is all the struct error says
+            raise MidiException("midi cache is truncated") from None
+        if magic != _CACHE_MAGIC or version != _CACHE_VERSION or \
+                long_size != _LONG_SIZE or little_endian != _LITTLE_ENDIAN:
+            raise MidiException("not a midi cache for this version and platform")
+        if (source_size is not None and size != source_size) or \
+                (source_mtime is not None and mtime != source_mtime):
+            raise MidiException("midi cache is out of date")
+        compact = cls()
+        compact.format = midi_format
+        compact.ticks_per_quarter_note = ticks_per_quarter_note
+        compact.ticks_per_second = ticks_per_second or None
+        pos = _CACHE_HEADER.size
+
+        def read_struct(layout: struct.Struct) -> Tuple:
+            nonlocal pos
+            try:
+                values = layout.unpack_from(buf, pos)
+            except struct.error:
+                raise MidiException("midi cache is truncated") from None
+            pos += layout.size
+            return values
+
+        def read_column(typecode: str, length: int) -> array:
+            nonlocal pos
+            column = array(typecode)
+            end = pos + length * column.itemsize
+            if end > len(buf):
+                raise MidiException("midi cache is truncated")
+            column.frombytes(buf[pos:end])
+            pos = end
+            return column
+
+        num_signatures, = read_struct(_CACHE_COUNT)
+        ticks = read_column(_CACHE_LONG, num_signatures)
+        numerators = read_column('B', num_signatures)
+        denominators = read_column('B', num_signatures)
+        compact.time_signatures = list(zip(ticks, numerators, denominators))
+        for _ in range(num_tracks):
+            index, num_events, payload_size = read_struct(_CACHE_TRACK_HEADER)
+            track = CompactTrack(index)
+            track.ticks = array('L', read_column(_CACHE_LONG, num_events))
+            track.status = read_column('B', num_events)
+            track.data1 = read_column('B', num_events)
+            track.data2 = read_column('B', num_events)
+            track.payload_offsets = array(
+                'L', read_column(_CACHE_LONG, num_events))
+            track.payload_lengths = array(
+                'L', read_column(_CACHE_LONG, num_events))
+            track.payload = bytearray(read_column('B', payload_size))
+            compact.tracks.append(track)
+        return compact
+
+def get_cache_path(midi_path: Path) -> Path:
+    """Path of the parsed midi cache that belongs to midi_path."""
+    return midi_path.with_name(midi_path.name + CACHE_SUFFIX)
+
+def load_cached_midi(midi_path: Path) -> CompactMidiFile:
+    """
+    Load midi_path in compact form, from its cache if that is up to date.
+
+    The cache is keyed by the size and modification time of the midi
+    file, so lilypond writing a new file makes it miss. On a miss the
+    file is parsed and the cache (re)written.
+    """
+    stat = midi_path.stat()
+    cache_path = get_cache_path(midi_path)
+    try:
+        return CompactMidiFile.loads(
+            cache_path.read_bytes(), stat.st_size, stat.st_mtime_ns)
+    except (OSError, MidiException):
+        pass
+    compact = CompactMidiFile()
+    compact.readstr(midi_path.read_bytes())
+    # write next to the cache and rename, so a reader never sees half;
+    # every writer has its own temporary file, several processes may
+    # write the same cache at once
+    partial_name = None
+    try:
+        partial_fd, partial_name = tempfile.mkstemp(
+            prefix=cache_path.name + '.', suffix=PARTIAL_SUFFIX,
+            dir=str(cache_path.parent))
+        with os.fdopen(partial_fd, 'wb') as partial_file:
+            partial_file.write(compact.dumps(stat.st_size, stat.st_mtime_ns))
+        os.replace(partial_name, str(cache_path))
+    except OSError:
+        if partial_name is not None:
+            try:
+                os.unlink(partial_name)
+            except OSError:
+                pass
+    return compact
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,20 +1,40 @@
 """Compile lily code into png and midi."""
+import os
 import sys
 import re
-from typing import Dict, Tuple, Callable
+import json
+import tempfile
+from argparse import ArgumentParser
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import partial
+from itertools import chain
+from typing import Dict, List, Tuple, Callable, Iterable, Iterator
 from pathlib import Path
-from asyncio import create_subprocess_exec
+from asyncio import create_subprocess_exec, get_event_loop
 from asyncio.subprocess import PIPE
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from PIL import Image, ImageTk
 
 from voicetrainer.midi import (
-    MidiFile, MidiTrack, DeltaTime, MidiEvent, get_numbers_as_list)
+    MidiFile, MidiEvent, MidiException, EVENT_KINDS, META_EVENTS,
+    TempoMap, VelocityPatcher, get_numbers_as_list, read_number, scale_tempo_data,
+    transpose_error, transpose_table)
+from voicetrainer.compact_midi import (
+    PARTIAL_SUFFIX, CompactMidiFile, CompactTrack, load_cached_midi, write_rows)
 from voicetrainer.compile_interface import FileType, Interface
 
+_TRACK_NAME = re.compile(b"([a-zA-Z_\\-0-9]+):([0-9]+:)?")
+_SEQUENCE_TRACK_NAME = META_EVENTS.SEQUENCE_TRACK_NAME
+_SET_TEMPO = META_EVENTS.SET_TEMPO
+
 # some state
 _ERR_CB = print
 _COMPILER_CB = lambda _: None
+# worker process for midi post-processing, started on first use
+_EXECUTOR = None
 
 def set_err_cb(err_cb: Callable[[str], None]):
     """Give module a way to report errors."""
@@ -26,52 +46,278 @@ def set_compiler_cb(compiler_cb: Callable[[int], None]):
     global _COMPILER_CB
     _COMPILER_CB = compiler_cb
 
-def measure_to_tick(time_changes, measure, ticks_per_quarter_note):
-    """Convert measure to tick."""
-    ticks = 0
-    closest_m = 1
-    quarts_m = 4
-    for next_tick, next_quarts_m in time_changes:
-        next_measure = get_measure_num(
-            time_changes, next_tick, ticks_per_quarter_note)
-        if next_measure > measure:
-            break
-        else:
-            closest_m = next_measure
-            ticks = next_tick
-            quarts_m = next_quarts_m
-    ticks += (measure - closest_m) * quarts_m * ticks_per_quarter_note
-    return ticks
-
-def get_measure_num(time_changes, total_ticks, ticks_per_quarter_note):
-    """Get current measure number."""
-    measure = 1
-    curr_tick = 0
-    curr_quarts_m = 4
-    for next_tick, next_quarts_m in time_changes:
-        stop = False
-        if next_tick == curr_tick:
-            # overwrite current quarts_per_minute
-            curr_quarts_m = next_quarts_m
-            continue
-        if total_ticks < next_tick:
-            # not at this time change yet
-            next_tick = total_ticks
-            # stop after this
-            stop = True
-        delta_tick = next_tick - curr_tick
-        delta_measure = (delta_tick // ticks_per_quarter_note) // curr_quarts_m
-        curr_tick = next_tick
-        curr_quarts_m = next_quarts_m
-        measure += delta_measure
-        if stop:
-            break
-    if curr_tick != total_ticks:
-        # we didn't reach total_ticks
-        delta_tick = total_ticks - curr_tick
-        delta_measure = (delta_tick // ticks_per_quarter_note) // curr_quarts_m
-        measure += delta_measure
-    return measure
+def _get_executor() -> ProcessPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        # a single worker, so its base midi cache and snapshots stay warm
+        # instead of being rebuilt in every worker a request lands on
+        _EXECUTOR = ProcessPoolExecutor(max_workers=1)
+    return _EXECUTOR
+
+def shutdown_workers():
+    """Stop midi post-processing worker processes, without waiting for them."""
+    global _EXECUTOR
+    if _EXECUTOR is not None:
+        _EXECUTOR.shutdown(wait=False)
+        _EXECUTOR = None
+
+class BaseMidi:
+
+    """
+    Midi file as compiled by lilypond, that variants are derived from.
+
+    Parsed lazily, once for every way of deriving variants.
+    """
+
+    def __init__(self, path: Path, version: Tuple[int, int]) -> None:
+        self.path = path
+        # size and mtime of the file when it was first seen
+        self.version = version
+        self._patcher = None
+        self._compact = None
+        self._snapshots = None
+
+    @property
+    def patcher(self) -> VelocityPatcher:
+        """Velocity byte offsets, for variants that only change velocity."""
+        if self._patcher is None:
+            self._patcher = VelocityPatcher(self.path.read_bytes())
+        return self._patcher
+
+    @property
+    def compact(self) -> CompactMidiFile:
+        """Array form, for all other variants."""
+        if self._compact is None:
+            self._compact = load_cached_midi(self.path)
+        return self._compact
+
+    @property
+    def snapshots(self) -> 'MeasureSnapshots':
+        """State at every measure, for variants that start later."""
+        if self._snapshots is None:
+            self._snapshots = MeasureSnapshots(self.compact)
+        return self._snapshots
+
+class BaseMidiCache:
+
+    """
+    Least recently used cache of base midi files.
+
+    Keyed by everything that goes into the lilypond compile: name, base
+    bpm and base pitch. Start measure, velocities, tempo, key and
+    instrument selection are applied afterwards, so all their variants
+    share an entry.
+
+    Variants are derived in the midi worker process, so the parsed base
+    midi files live in the worker's copy of this cache. In the main
+    process it is only a stat based check whether a base midi exists.
+    """
+
+    def __init__(self, max_size: int=8) -> None:
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def get_key(interface: Interface) -> Tuple:
+        """Key for the base midi of interface."""
+        return (
+            str(interface.data_path), interface.name, interface.base_bpm,
+            interface.base_pitch)
+
+    def get(self, interface: Interface) -> BaseMidi:
+        """Return base midi of interface, or None if it was not compiled."""
+        key = self.get_key(interface)
+        path = interface.get_filename(FileType.midi, compiling=True)
+        try:
+            stat = path.stat()
+        except OSError:
+            self._entries.pop(key, None)
+            return None
+        version = (stat.st_size, stat.st_mtime_ns)
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            # new or recompiled
+            entry = BaseMidi(path, version)
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        """Forget all base midi files."""
+        self._entries.clear()
+
+_BASE_MIDIS = BaseMidiCache()
+
+class MeasureMap:
+
+    """
+    Measure numbers of a piece, from its (tick, quarters per measure) changes.
+
+    Built once as cumulative (tick, measure, quarters per measure)
+    breakpoints, one per tick with a time change, so both directions of
+    lookup are a bisect. Before the first change a measure is 4
+    quarters long.
+
+    >>> # 4/4 for two measures, then 3/4 for two, then 6/4
+    >>> measure_map = MeasureMap([(0, 4), (3072, 3), (5376, 6)], 384)
+    >>> [measure_map.get_measure_num(tick) for tick in (0, 1535, 1536, 3072, 4224, 5376, 7680)]
+    [1, 1, 2, 3, 4, 5, 6]
+    >>> [measure_map.measure_to_tick(measure) for measure in (0, 1, 3, 4, 6)]
+    [-1536, 0, 3072, 4224, 7680]
+    >>> measure_map.first_tick_of_measure(4, 10000)
+    4224
+    >>> measure_map.first_tick_of_measure(7, 8000)
+    8001
+    """
+
+    def __init__(
+            self,
+            time_changes: Iterable[Tuple[int, float]],
+            ticks_per_quarter_note: int) -> None:
+        self.ticks_per_quarter_note = ticks_per_quarter_note
+        self.ticks = [0]
+        self.measures = [1]
+        self.quarters = [4]
+        for tick, quarters in time_changes:
+            if tick == self.ticks[-1]:
+                # overwrite current quarters per measure
+                self.quarters[-1] = quarters
+                continue
+            self.measures.append(self.get_measure_num(tick))
+            self.ticks.append(tick)
+            self.quarters.append(quarters)
+
+    def get_measure_num(self, total_ticks: int):
+        """Get measure number at tick."""
+        i = bisect_right(self.ticks, total_ticks) - 1
+        delta_tick = total_ticks - self.ticks[i]
+        return self.measures[i] + \
+            (delta_tick // self.ticks_per_quarter_note) // self.quarters[i]
+
+    def measure_to_tick(self, measure):
+        """Convert measure to tick."""
+        i = bisect_right(self.measures, measure) - 1
+        if i < 0:
+            # before measure 1, count back from the start
+            return (measure - 1) * 4 * self.ticks_per_quarter_note
+        return self.ticks[i] + \
+            (measure - self.measures[i]) * self.quarters[i] * self.ticks_per_quarter_note
+
+    def first_tick_of_measure(self, measure, max_tick: int) -> int:
+        """
+        Find the first tick that get_measure_num places in measure or later.
+
+        Returns max_tick + 1 if no tick up to max_tick gets there.
+        """
+        low = 0
+        high = max_tick + 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_measure_num(middle) < measure:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+def _state_key(index: int, row: 'Row'):
+    """
+    What row sets, later rows with the same key replace it.
+
+    Notes don't set anything and get None, sysex events can't be
+    compared and get their own key.
+    """
+    status, data1 = row[1], row[2]
+    if status < 0xA0:
+        return None
+    if status < 0xF0:
+        if status & 0xF0 in (0xA0, 0xB0):
+            # per pitch or per controller
+            return (status, data1)
+        return (status,)
+    if status == 0xFF:
+        return (status, data1)
+    return index
+
+class MeasureSnapshots:
+
+    """
+    State of every track at the start of every measure.
+
+    The state is everything but notes that comes before the measure:
+    program, controllers, pitch bend, tempo, time and key signature,
+    track name, and so on, only the last event of every kind per
+    channel. Together with the index of the first event in the measure
+    it is all that is needed to start playing there, without going over
+    the events before it again.
+
+    >>> midi = CompactMidiFile()
+    >>> midi.ticks_per_quarter_note = 1
+    >>> track = CompactTrack(0)
+    >>> for row in [
+    ...         (0, 0xFF, 0x03, 0, b'alto:'), (0, 0xC0, 52, 0, b''),
+    ...         (0, 0xB0, 7, 100, b''), (0, 0x90, 60, 100, b''),
+    ...         (4, 0x80, 60, 0, b''), (4, 0xB0, 7, 80, b''), (6, 0xC0, 53, 0, b''),
+    ...         (8, 0x90, 62, 100, b''), (12, 0x80, 62, 0, b''), (12, 0xFF, 0x2F, 0, b'')]:
+    ...     track.append(*row)
+    >>> midi.tracks.append(track)
+    >>> snapshots = MeasureSnapshots(midi)
+    >>> snapshots.start_ticks
+    [0, 4, 8, 12, 13]
+    >>> for row in snapshots.rows(0, 3):
+    ...     print(row)
+    (0, 255, 3, 0, b'alto:')
+    (4, 176, 7, 80, b'')
+    (6, 192, 53, 0, b'')
+    (8, 144, 62, 100, b'')
+    (12, 128, 62, 0, b'')
+    (12, 255, 47, 0, b'')
+    """
+
+    def __init__(self, midi: CompactMidiFile) -> None:
+        # time signatures come from the table in the cache, so they are
+        # known before the tracks are read
+        self.measure_map = MeasureMap(
+            [(tick, _quarters_per_measure(numerator, denominator))
+             for tick, numerator, denominator in midi.time_signatures],
+            midi.ticks_per_quarter_note)
+        max_tick = max([track.ticks[-1] for track in midi.tracks if len(track)] + [0])
+        # first tick of every measure, and of the one after the last
+        self.start_ticks = [
+            self.measure_map.first_tick_of_measure(measure, max_tick)
+            for measure in range(1, int(self.measure_map.get_measure_num(max_tick)) + 2)]
+        self.tracks = midi.tracks
+        # per track and measure: (index of first event, state rows)
+        self.snapshots = [self._snapshot_track(track) for track in midi.tracks]
+
+    def _snapshot_track(self, track: CompactTrack) -> List[Tuple[int, Tuple['Row', ...]]]:
+        state = OrderedDict()
+        snapshots = []
+        for index, row in enumerate(track.rows()):
+            while len(snapshots) < len(self.start_ticks) and \
+                    self.start_ticks[len(snapshots)] <= row[0]:
+                snapshots.append((index, tuple(state.values())))
+            key = _state_key(index, row)
+            if key is not None:
+                # keep the order in which the state was last set
+                state.pop(key, None)
+                state[key] = row
+        while len(snapshots) < len(self.start_ticks):
+            snapshots.append((len(track), tuple(state.values())))
+        return snapshots
+
+    def _clamp(self, measure: int) -> int:
+        return min(max(measure, 1), len(self.start_ticks)) - 1
+
+    def start_tick(self, measure: int) -> int:
+        """First tick in measure, one past the last tick if it is past the end."""
+        return self.start_ticks[self._clamp(measure)]
+
+    def rows(self, track_num: int, measure: int) -> Iterator['Row']:
+        """State rows of track at measure, then all rows from measure on."""
+        index, state = self.snapshots[track_num][self._clamp(measure)]
+        return chain(state, self.tracks[track_num].rows(index))
 
 async def compile_(interface: Interface, file_type: FileType) -> None:
     """Open interface file, format, and compile with lilypond."""
@@ -84,9 +330,8 @@ async def compile_(interface: Interface, file_type: FileType) -> None:
     outs, errs = await proc.communicate(str.encode(
         interface.get_final_lily_code(file_type)))
     if file_type is FileType.midi and \
-            (interface.start_measure > 1 or \
-             interface.velocity != 0 or \
-             any([velocity != 0 for velocity in interface.instrument_velocities])):
+            interface.get_filename(file_type) != \
+            interface.get_filename(file_type, compiling=True):
         await create_clipped_midi(interface)
     _COMPILER_CB(-1)
     if len(outs) > 0:
@@ -94,138 +339,254 @@ async def compile_(interface: Interface, file_type: FileType) -> None:
     if len(errs) > 0:
         _ERR_CB(bytes.decode(errs))
 
-def midi_generator(midi: MidiFile) -> Tuple[int, DeltaTime, MidiEvent]:
-    """Iterate over midi events."""
-    for i, track in enumerate(midi.tracks):
-        delta_time = None
-        for event in track.events:
-            if event.is_delta_time():
-                delta_time = event
+def get_track_instrument(track_name: bytes) -> str:
+    """Extract instrument name from a lilypond track name, or None."""
+    if track_name is None:
+        return None
+    match = _TRACK_NAME.match(track_name)
+    if match:
+        return match.group(1).decode('utf-8')
+    return None
+
+def _unmatched_instruments(
+        matched_tracks: Dict[str, int],
+        action: str="apply instrument specific relative velocity") -> List[str]:
+    if any([matched_tracks[instrument] == 0 for instrument in matched_tracks]):
+        return [(
+            "no named tracks were found for {}, could not {}").format(
+                ", ".join([
+                    instrument for instrument in matched_tracks \
+                    if matched_tracks[instrument] == 0]),
+                action)]
+    return []
+
+def _get_tempo_factor(interface: Interface) -> float:
+    """How much faster than the compiled base midi interface should be."""
+    return interface.bpm / interface.base_bpm
+
+def _get_base_midi(interface: Interface) -> BaseMidi:
+    base = _BASE_MIDIS.get(interface)
+    if base is None:
+        raise FileNotFoundError("no compiled midi: {}".format(
+            interface.get_filename(FileType.midi, compiling=True)))
+    return base
+
+def create_velocity_midi(interface: Interface) -> List[str]:
+    """
+    Adjust velocities, tempo and key only, by patching bytes of the base midi.
+
+    Returns warnings.
+    """
+    patcher = _get_base_midi(interface).patcher
+    matched_tracks = {
+        instrument: 0 for instrument in interface.midi_instruments \
+        if interface.midi_instruments[instrument]}
+    track_velocities = {}
+    for track_num, track_name in enumerate(patcher.track_names):
+        if not interface.has_instruments:
+            break
+        instrument = get_track_instrument(track_name)
+        if instrument in interface.instrument_velocities:
+            track_velocities[track_num] = interface.instrument_velocities[
+                instrument]
+            if instrument in matched_tracks:
+                matched_tracks[instrument] += 1
+    interface.get_filename(FileType.midi).write_bytes(
+        patcher.patch(
+            interface.velocity, track_velocities, _get_tempo_factor(interface),
+            interface.get_transposition()))
+    return _unmatched_instruments(matched_tracks)
+
+def _quarters_per_measure(numerator: int, denominator: int) -> float:
+    # t_signature explained:
+    # in a 4/4 time signature, meaning there 4 quarter notes
+    # in a measure,
+    # numerator is the first 4
+    # pow(2, denominator) is the divisor, or the second 4
+    return (numerator * pow(2, denominator)) / (pow(2, denominator)) / 4
+
+Row = Tuple[int, int, int, int, bytes]
+Stage = Callable[[Iterator[Row]], Iterator[Row]]
+
+def mute_stage(
+        rows: Iterable[Row],
+        muted_tracks: Dict[str, int]) -> Iterator[Row]:
+    """
+    Drop channel messages from the track name of a muted instrument on.
+
+    Meta events stay, so tempo and time signatures of the track still
+    apply. Muted tracks are counted per instrument in muted_tracks.
+    """
+    muted_instrument = None
+    for row in rows:
+        status, data1, payload = row[1], row[2], row[4]
+        if status == 0xFF and data1 == _SEQUENCE_TRACK_NAME:
+            muted_instrument = get_track_instrument(payload)
+            if muted_instrument in muted_tracks:
+                muted_tracks[muted_instrument] += 1
             else:
-                yield (i, delta_time, event)
+                muted_instrument = None
+        elif muted_instrument is not None and status < 0xF0:
+            continue
+        yield row
 
-class MidiIterator:
+def velocity_stage(
+        rows: Iterable[Row],
+        interface: Interface,
+        matched_tracks: Dict[str, int]) -> Iterator[Row]:
+    """
+    Adjust note velocities by the global and instrument velocity.
 
-    """Wrap midi_generator so it can be used asynchronously."""
+    The instrument velocity applies from the track name on, matched
+    tracks are counted per instrument in matched_tracks.
+    """
+    velocity = interface.velocity
+    for row in rows:
+        tick, status, data1, data2, payload = row
+        if status == 0xFF and data1 == _SEQUENCE_TRACK_NAME:
+            velocity = interface.velocity
+            instrument = get_track_instrument(payload)
+            if interface.has_instruments and \
+                    instrument in interface.instrument_velocities:
+                velocity += interface.instrument_velocities[instrument]
+                if instrument in matched_tracks:
+                    matched_tracks[instrument] += 1
+        elif 0x80 <= status < 0xA0:
+            # velocity 0 is a note off and stays that way
+            if data2 != 0:
+                row = (
+                    tick, status, data1,
+                    min(max(data2 + velocity, 0), 127), payload)
+        yield row
 
-    def __init__(self, midi: MidiFile):
-        self.midi = midi
-        self.iterator = midi_generator(midi)
+def tempo_stage(rows: Iterable[Row], factor: float) -> Iterator[Row]:
+    """Make all SET_TEMPO events factor times as fast."""
+    for row in rows:
+        tick, status, data1, data2, payload = row
+        if status == 0xFF and data1 == _SET_TEMPO and len(payload) == 3:
+            row = (tick, status, data1, data2, scale_tempo_data(payload, factor))
+        yield row
 
-    async def __aiter__(self):
-        return self
+def transpose_stage(rows: Iterable[Row], semitones: int) -> Iterator[Row]:
+    """Shift all note pitches by semitones, leaving channel 10 (drums) alone."""
+    table = transpose_table(semitones)
+    for row in rows:
+        tick, status, data1, data2, payload = row
+        if 0x80 <= status < 0xA0 and status & 0x0F != 9:
+            pitch = table[data1]
+            if pitch == 0xFF:
+                raise transpose_error(data1, semitones)
+            row = (tick, status, pitch, data2, payload)
+        yield row
 
-    async def __anext__(self):
-        try:
-            return next(self.iterator)
-        except StopIteration:
-            raise StopAsyncIteration
-
-async def _collect_time_changes(midi: MidiFile):
-    time_changes = []
-    total_ticks = [0] * len(midi.tracks)
-    async for track_num, delta_time, event in MidiIterator(midi):
-        total_ticks[track_num] += delta_time.time
-        if event.type_ == "TIME_SIGNATURE":
-            # t_signature explained:
-            # in a 4/4 time signature, meaning there 4 quarter notes
-            # in a measure,
-            # t_signature[0] is the numerator, or the first 4
-            # pow(2, t_signature[1]) is the divisor, or the second 4
-            t_signature = get_numbers_as_list(event.data)
-            # what we're doing here in essence is changes in number
-            # of quarter notes per measure at the cumulative tick count
-            time_changes.append(
-                (
-                    total_ticks[track_num],
-                    (t_signature[0] * pow(2, t_signature[1])) / (pow(2, t_signature[1])) / 4 ))
-    return time_changes
+def clip_stage(
+        rows: Iterable[Row],
+        start_tick: int,
+        start_measure_tick: float) -> Iterator[Row]:
+    """
+    Drop notes before start_tick and move the other events there to 0.
 
-async def create_clipped_midi(interface: Interface):
-    """Start midi from start_measure, with events intact."""
-    midi = MidiFile()
-    midi.open(str(interface.get_filename(
-        FileType.midi, compiling=True)))
-    midi.read()
-    midi.close()
-
-    new_midi = MidiFile()
-    new_midi.ticks_per_quarter_note = midi.ticks_per_quarter_note
-    new_midi.format = midi.format
-    for track_num, _ in enumerate(midi.tracks):
-        new_midi.tracks.append(MidiTrack(track_num))
-
-    ticks_per_quarter_note = midi.ticks_per_quarter_note
-    time_changes = await _collect_time_changes(midi)
-    total_ticks = [0] * len(midi.tracks)
-    instruments = {}
+    Kept events keep their spacing, the first one is placed relative to
+    the start of the measure at start_measure_tick.
+    """
+    shift = None
+    for row in rows:
+        tick, status, data1, data2, payload = row
+        if tick < start_tick:
+            if not 0x80 <= status < 0xA0:
+                yield (0, status, data1, data2, payload)
+            continue
+        if shift is None:
+            shift = max(int(tick - start_measure_tick), 0) - tick
+        yield (tick + shift, status, data1, data2, payload)
+
+def run_stages(rows: Iterable[Row], stages: List[Stage]) -> Iterator[Row]:
+    """Chain stages, every row goes through all of them in one pass."""
+    for stage in stages:
+        rows = stage(rows)
+    return rows
+
+def derive_midi(interface: Interface) -> List[str]:
+    """
+    Write the midi of interface, derived from its compiled base midi.
+
+    Starts from start_measure, with events intact. Returns warnings.
+    """
+    muted_tracks = {
+        instrument: 0 for instrument in interface.get_muted_instruments()}
+    if interface.start_measure <= 1 and not muted_tracks:
+        # nothing to clip or drop
+        return create_velocity_midi(interface)
+    base = _get_base_midi(interface)
+    midi = base.compact
     matched_tracks = {
         instrument: 0 for instrument in interface.midi_instruments \
         if interface.midi_instruments[instrument]}
-    async for track_num, delta_time, event in MidiIterator(midi):
-        total_ticks[track_num] += delta_time.time
-        measure = get_measure_num(
-            time_changes,
-            total_ticks[track_num],
-            ticks_per_quarter_note)
-
-        # store instrument name
-        if event.type_ == "SEQUENCE_TRACK_NAME":
-            instruments[str(track_num)] = event.data
-
-        # adjust velocity
-        if event.type_ in ['NOTE_ON', 'NOTE_OFF']:
-            new_velocity = event.velocity + interface.velocity
-            if str(track_num) in instruments and interface.has_instruments:
-                track_name = re.match(
-                    b"([a-zA-Z_\\-0-9]+):([0-9]+:)?",
-                    instruments[str(track_num)])
-                if track_name:
-                    track_name = track_name.group(1).decode('utf-8')
-                    if track_name in interface.instrument_velocities:
-                        new_velocity += interface.instrument_velocities[
-                            track_name]
-                        matched_tracks[track_name] += 1
-
-            if new_velocity < 0:
-                new_velocity = 0
-            elif new_velocity > 127:
-                new_velocity = 127
-            event.velocity = new_velocity
-
-        # the actual clipping
-        if event.type_ in ['NOTE_ON', 'NOTE_OFF'] and \
-                measure < interface.start_measure:
-            continue
-        else:
-            if measure < interface.start_measure:
-                # insert event with timedelta 0
-                delta_time.time = 0
-            else:
-                prev_m = get_measure_num(
-                    time_changes,
-                    total_ticks[track_num] - delta_time.time,
-                    ticks_per_quarter_note)
-                if prev_m < interface.start_measure:
-                    delta_time.time = int(
-                        total_ticks[track_num] - measure_to_tick(
-                            time_changes,
-                            interface.start_measure,
-                            ticks_per_quarter_note))
-            new_midi.tracks[track_num].events.append(delta_time)
-            new_midi.tracks[track_num].events.append(event)
-    for track in new_midi.tracks:
-        track.update_events()
-    new_midi.open(str(interface.get_filename(FileType.midi)), 'wb')
-    new_midi.write()
-    new_midi.close()
-    if any([matched_tracks[instrument] == 0 for instrument in matched_tracks]):
-        _ERR_CB((
-            "no named tracks were found for {}, could not "
-            "apply instrument specific relative velocity").format(
-                ", ".join([
-                    instrument for instrument in matched_tracks \
-                    if matched_tracks[instrument] == 0])))
+    stages = [
+        partial(mute_stage, muted_tracks=muted_tracks),
+        partial(velocity_stage, interface=interface, matched_tracks=matched_tracks)]
+    snapshots = None
+    if interface.start_measure > 1:
+        # tracks start with their state at start_measure, everything
+        # before its first tick is clipped
+        snapshots = base.snapshots
+        stages.append(partial(
+            clip_stage,
+            start_tick=snapshots.start_tick(interface.start_measure),
+            start_measure_tick=snapshots.measure_map.measure_to_tick(
+                interface.start_measure)))
+    if interface.bpm != interface.base_bpm:
+        stages.append(partial(tempo_stage, factor=_get_tempo_factor(interface)))
+    if interface.pitch != interface.base_pitch:
+        stages.append(partial(
+            transpose_stage, semitones=interface.get_transposition()))
+
+    # tracks are encoded and written one at a time, to a temporary file
+    # that is renamed when complete, so a failing stage leaves no
+    # truncated midi behind
+    path = interface.get_filename(FileType.midi)
+    partial_fd, partial_name = tempfile.mkstemp(
+        prefix=path.name + '.', suffix=PARTIAL_SUFFIX, dir=str(path.parent))
+    try:
+        with os.fdopen(partial_fd, 'wb') as midi_file:
+            midi_file.write(midi.get_header())
+            for track_num, track in enumerate(midi.tracks):
+                if snapshots is None:
+                    rows = track.rows()
+                else:
+                    rows = snapshots.rows(track_num, interface.start_measure)
+                out = bytearray()
+                write_rows(out, run_stages(rows, stages), running_status=True)
+                midi_file.write(out)
+        os.replace(partial_name, str(path))
+    except BaseException:
+        os.unlink(partial_name)
+        raise
+    return _unmatched_instruments(matched_tracks) + \
+        _unmatched_instruments(muted_tracks, "mute them")
+
+async def create_clipped_midi(interface: Interface):
+    """
+    Run derive_midi in a worker process, keeping the event loop free.
+
+    Only interface, which is names, paths and numbers, goes to the
+    worker, and only warnings come back. The worker reads the base midi
+    files itself, from their binary cache, and keeps them parsed between
+    calls.
+    """
+    global _EXECUTOR
+    _COMPILER_CB(1)
+    try:
+        warnings = await get_event_loop().run_in_executor(
+            _get_executor(), derive_midi, interface)
+    except BrokenProcessPool:
+        # the worker died, start a new one next time
+        _EXECUTOR = None
+        raise
+    finally:
+        _COMPILER_CB(-1)
+    for warning in warnings:
+        _ERR_CB(warning)
 
 async def get_single_sheet(
         image_cache: Dict,
@@ -261,22 +622,240 @@ async def get_file(
     file_name = interface.get_filename(file_type)
     # TODO: check for naming madness with pages
     if not file_name.is_file():
-        await compile_(interface, file_type)
+        if file_type is FileType.midi and _BASE_MIDIS.get(interface) is not None:
+            # a variant of a compiled midi, no need for lilypond
+            await create_clipped_midi(interface)
+        else:
+            await compile_(interface, file_type)
     if not file_name.is_file():
         _ERR_CB("could not compile {}".format(file_name))
     return file_name
 
-def midi_introspection():
-    """Show contents of midi file in a readable format."""
-    if len(sys.argv) != 2:
-        print("usage: midi_introspection file")
-        return
+def _event_to_dict(track_num: int, tick: int, event: MidiEvent) -> Dict:
+    """Json friendly version of event."""
+    entry = {'track': track_num, 'tick': tick, 'type': event.type_}
+    if event.channel is not None:
+        entry['channel'] = event.channel
+    if event.kind in (EVENT_KINDS.NOTE_ON, EVENT_KINDS.NOTE_OFF):
+        entry['pitch'] = event.pitch
+        entry['velocity'] = event.velocity
+    elif event.velocity is None:
+        if isinstance(event.data, bytes):
+            entry['data'] = event.data.hex()
+        elif event.data is not None:
+            entry['data'] = event.data
+    else:
+        entry['data'] = [event.data, event.velocity]
+    return entry
+
+def _matches(
+        event: MidiEvent,
+        kinds: List[int]=None,
+        channels: List[int]=None) -> bool:
+    return (kinds is None or event.kind in kinds) and \
+        (channels is None or event.channel in channels)
+
+def midi_summary(
+        file_name: str,
+        kinds: List[int]=None,
+        channels: List[int]=None) -> Dict:
+    """
+    Summarize midi file in a single streaming pass.
+
+    Event counts only include events of the given kinds and channels,
+    names, time signatures and tempo changes are always collected.
+    """
     midi = MidiFile()
-    midi.open(sys.argv[1])
-    midi.read()
-    midi.close()
-
-    for track in midi.tracks:
-        print("\n\ntrack number {}".format(track.index))
-        for event in track.events:
-            print(repr(event))
+    midi.open(file_name, use_mmap=True)
+    tracks = []
+    time_signatures = []
+    tempo_changes = []
+    events = midi.iter_events()
+    try:
+        for track_num, tick, event in events:
+            while len(tracks) <= track_num:
+                tracks.append({
+                    'name': None, 'events': 0, 'notes': 0,
+                    'channels': set(), 'last_tick': 0})
+            track = tracks[track_num]
+            track['last_tick'] = tick
+            if event.kind == EVENT_KINDS.SEQUENCE_TRACK_NAME and track['name'] is None:
+                track['name'] = bytes(event.data).decode('utf-8', 'replace')
+            elif event.kind == EVENT_KINDS.TIME_SIGNATURE:
+                t_signature = get_numbers_as_list(event.data)
+                time_signatures.append((tick, "{}/{}".format(
+                    t_signature[0], pow(2, t_signature[1]))))
+            elif event.kind == EVENT_KINDS.SET_TEMPO and len(event.data) == 3:
+                tempo_changes.append((tick, read_number(event.data, 0, 3)[0]))
+            if not _matches(event, kinds, channels):
+                continue
+            track['events'] += 1
+            if event.kind == EVENT_KINDS.NOTE_ON and event.velocity > 0:
+                track['notes'] += 1
+            if event.channel is not None:
+                track['channels'].add(event.channel)
+    finally:
+        # the generator holds a view of the mapped file
+        events.close()
+        midi.close()
+    tempo_map = TempoMap(
+        midi.ticks_per_quarter_note, tempo_changes, midi.ticks_per_second)
+    last_tick = max([track['last_tick'] for track in tracks] + [0])
+    for track in tracks:
+        track['channels'] = sorted(track['channels'])
+    return {
+        'file': file_name,
+        'format': midi.format,
+        'ticks_per_quarter_note': midi.ticks_per_quarter_note,
+        'ticks': last_tick,
+        'duration': tempo_map.tick_to_seconds(last_tick),
+        'time_signatures': sorted(time_signatures, key=lambda change: change[0]),
+        'tempo_changes': [
+            (tick, round(60000000.0 / max(tempo, 1), 2))
+            for tick, tempo in sorted(tempo_changes, key=lambda change: change[0])],
+        'tracks': tracks}
+
+def _format_summary(summary: Dict) -> Iterator[str]:
+    minutes, seconds = divmod(summary['duration'], 60)
+    yield "{}: format {}, {} tracks, {} ticks per quarter note, {} ticks, {:d}:{:05.2f}".format(
+        summary['file'], summary['format'], len(summary['tracks']),
+        summary['ticks_per_quarter_note'], summary['ticks'], int(minutes), seconds)
+    yield "time signatures: {}".format(", ".join([
+        "{} at {}".format(signature, tick)
+        for tick, signature in summary['time_signatures']]) or "none")
+    yield "tempo changes: {}".format(", ".join([
+        "{} bpm at {}".format(bpm, tick)
+        for tick, bpm in summary['tempo_changes']]) or "none")
+    for track_num, track in enumerate(summary['tracks']):
+        yield "track {} {}: {} events, {} notes, channels {}".format(
+            track_num, json.dumps(track['name']), track['events'], track['notes'],
+            ", ".join([str(channel) for channel in track['channels']]) or "none")
+
+def _list_events(
+        file_name: str,
+        kinds: List[int]=None,
+        channels: List[int]=None,
+        as_json: bool=False) -> Iterator[str]:
+    midi = MidiFile()
+    midi.open(file_name, use_mmap=True)
+    current_track = None
+    events = midi.iter_events()
+    try:
+        for track_num, tick, event in events:
+            if not _matches(event, kinds, channels):
+                continue
+            if as_json:
+                entry = _event_to_dict(track_num, tick, event)
+                entry['file'] = file_name
+                yield json.dumps(entry)
+                continue
+            if track_num != current_track:
+                current_track = track_num
+                yield "\n\ntrack number {}".format(track_num)
+            yield repr(event)
+    finally:
+        events.close()
+        midi.close()
+
+def _write_lines(lines: Iterable[str], buffer_size: int=4096) -> None:
+    """Write lines to stdout in chunks instead of one call per line."""
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= buffer_size:
+            chunk.append('')
+            sys.stdout.write("\n".join(chunk))
+            chunk = []
+    if chunk:
+        chunk.append('')
+        sys.stdout.write("\n".join(chunk))
+
+def midi_introspection():
+    """
+    Show contents of midi files in a readable format.
+
+    Files that can't be read are reported on stderr, the others are
+    still shown.
+
+    >>> import os, tempfile
+    >>> from voicetrainer.midi import DeltaTime, MidiTrack
+    >>> midi = MidiFile()
+    >>> for track_num in range(2):
+    ...     track = MidiTrack(track_num)
+    ...     name = MidiEvent(track, type_="SEQUENCE_TRACK_NAME")
+    ...     name.data = 'alto:'
+    ...     track.events = [DeltaTime(track, time=0), name]
+    ...     midi.tracks.append(track)
+    >>> good = midi.writestr()
+    >>> second = good.rindex(b'MTrk')
+    >>> directory = tempfile.TemporaryDirectory()
+    >>> cwd = os.getcwd()
+    >>> os.chdir(directory.name)
+    >>> _ = Path('bad.midi').write_bytes(good[:second] + b'MTrX' + good[second + 4:])
+    >>> _ = Path('good.midi').write_bytes(good)
+    >>> argv, stderr = sys.argv, sys.stderr
+    >>> sys.argv = ['midi_introspection', '-s', 'bad.midi', 'good.midi']
+    >>> sys.stderr = sys.stdout
+    >>> try:
+    ...     midi_introspection()
+    ... except SystemExit as exit_:
+    ...     print("exit", exit_.code)
+    ... finally:
+    ...     sys.argv, sys.stderr = argv, stderr
+    ...     os.chdir(cwd)
+    bad.midi: badly formed midi string: missing leading MTrk
+    good.midi: format 1, 2 tracks, 1024 ticks per quarter note, 0 ticks, 0:00.00
+    time signatures: none
+    tempo changes: none
+    track 0 "alto:": 1 events, 0 notes, channels none
+    track 1 "alto:": 1 events, 0 notes, channels none
+    exit 1
+    >>> directory.cleanup()
+    """
+    parser = ArgumentParser(
+        prog="midi_introspection",
+        description="Show contents of midi files.")
+    parser.add_argument('files', nargs='+', metavar='file')
+    parser.add_argument(
+        '-s', '--summary', action='store_true',
+        help="show track names, event counts, time signatures, tempo "
+        "changes and duration instead of all events")
+    parser.add_argument(
+        '-t', '--type', action='append', dest='types', metavar='TYPE',
+        help="only events of this type, e.g. NOTE_ON or SET_TEMPO; repeatable")
+    parser.add_argument(
+        '-c', '--channel', action='append', dest='channels', type=int,
+        metavar='CHANNEL', help="only events on this channel (1-16); repeatable")
+    parser.add_argument(
+        '-j', '--json', action='store_true',
+        help="json output: one object per event, or per file with --summary")
+    args = parser.parse_args()
+    kinds = None
+    if args.types is not None:
+        unknown = [type_ for type_ in args.types if not EVENT_KINDS.hasattr(type_)]
+        if unknown:
+            parser.error("unknown event type: {}".format(", ".join(unknown)))
+        kinds = [getattr(EVENT_KINDS, type_) for type_ in args.types]
+
+    failed = False
+    for file_name in args.files:
+        try:
+            if args.summary:
+                summary = midi_summary(file_name, kinds, args.channels)
+                if args.json:
+                    _write_lines([json.dumps(summary)])
+                else:
+                    _write_lines(_format_summary(summary))
+            else:
+                _write_lines(_list_events(
+                    file_name, kinds, args.channels, args.json))
+        except (OSError, MidiException) as err:
+            failed = True
+            sys.stderr.write("{}: {}\n".format(file_name, err))
+    sys.stdout.flush()
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
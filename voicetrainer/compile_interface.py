@@ -4,6 +4,8 @@ from enum import Enum
 from typing import List
 import re
 
+from voicetrainer.common import get_semitones
+
 def tokenize(text):
     """Break down text into a list of words."""
     return re.findall(r"\\?[%=:{}()]|\\?[a-zA-Z_\-0-9,.']+", text)
@@ -47,6 +49,16 @@ class Interface:
         self.start_measure = start_measure
         self.velocity = velocity
         self.config = self.get_config()
+        # midi is compiled at the default tempo of the lily file, other
+        # tempos are derived from that
+        try:
+            self.base_bpm = int(self.config['tempo'])
+        except (KeyError, ValueError):
+            self.base_bpm = bpm
+        # and in its default key, other keys are derived from that
+        self.base_pitch = self.config.get('key', pitch)
+        if get_semitones(self.base_pitch) is None or get_semitones(pitch) is None:
+            self.base_pitch = pitch
         self.midi_instruments = {instrument: True for instrument in self.config['instruments']}
         if midi_instruments is not None:
             self.midi_instruments.update(midi_instruments)
@@ -63,17 +75,21 @@ class Interface:
         extension = "ly"
         if file_type == FileType.midi:
             extension = "midi"
-            naming_elements.append("{}bpm".format(self.bpm))
-            naming_elements.append("{}".format(self.pitch))
+            naming_elements.append("{}bpm".format(
+                self.bpm if not compiling else self.base_bpm))
+            naming_elements.append("{}".format(
+                self.pitch if not compiling else self.base_pitch))
             naming_elements.append("velocity{}".format(
                 self.velocity if not compiling else 0))
             if self.has_instruments:
+                # midi is compiled with all instruments, others are muted afterwards
                 instruments = []
                 for instrument in self.midi_instruments:
-                    if self.midi_instruments[instrument]:
+                    if self.midi_instruments[instrument] or compiling:
                         instruments.append("{}-{}".format(
                             instrument,
-                            self.instrument_velocities[instrument]))
+                            self.instrument_velocities[instrument] \
+                            if not compiling else 0))
                 naming_elements.append('-'.join(instruments))
             if self.has_start_measure:
                 naming_elements.append("from-measure-{}".format(
@@ -103,6 +119,20 @@ class Interface:
         return self.data_path.joinpath("{}.{}".format(
             '-'.join(naming_elements), extension))
 
+    def get_transposition(self) -> int:
+        """Semitones between the compiled base midi and pitch."""
+        if self.pitch == self.base_pitch:
+            return 0
+        return get_semitones(self.pitch) - get_semitones(self.base_pitch)
+
+    def get_muted_instruments(self) -> List[str]:
+        """Instruments that are left out of the midi."""
+        if not self.has_instruments:
+            return []
+        return [
+            instrument for instrument in self.midi_instruments \
+            if not self.midi_instruments[instrument]]
+
     def get_lilypond_options(self, file_type: FileType) -> List[str]:
         """Return list of lilypond cli options to compile file_type."""
         partial_name = self.data_path.joinpath(
@@ -136,8 +166,10 @@ class Interface:
         for line in lily_code.split('\n'):
             tokens = tokenize(line)
             replace_strings = {
-                'voicetrainerTempo': self.bpm,
-                'voicetrainerKey': self.pitch,
+                'voicetrainerTempo': \
+                    self.bpm if file_type != FileType.midi else self.base_bpm,
+                'voicetrainerKey': \
+                    self.pitch if file_type != FileType.midi else self.base_pitch,
                 'voicetrainerSound': '"{}"'.format(self.sound)}
             if (
                     len(tokens) > 2 and
@@ -164,12 +196,6 @@ class Interface:
                     tokens[0] == '%' and \
                     tokens[1] == 'sheetonly':
                 ignore_count += 1 if tokens[2] == 'start' else -1
-            if file_type == FileType.midi and \
-                    self.has_instruments and len(tokens) > 3 and \
-                    tokens[0] == '%' and \
-                    tokens[1] == 'instrument':
-                if not self.midi_instruments[tokens[3]]:
-                    ignore_count += 1 if tokens[2] == 'start' else -1
             if ignore_count < 1:
                 keep_data.append(line)
         return '\n'.join(keep_data)
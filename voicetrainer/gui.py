@@ -6,7 +6,7 @@ from pathlib import Path
 import json
 
 from voicetrainer.compile import set_err_cb as set_compile_err_cb
-from voicetrainer.compile import set_compiler_cb, get_file
+from voicetrainer.compile import set_compiler_cb, get_file, shutdown_workers
 from voicetrainer.compile_interface import FileType
 from voicetrainer.aiotk import (
     Root,
@@ -327,4 +327,5 @@ def start():
     except KeyboardInterrupt:
         root.close(crash=True)
     finally:
+        shutdown_workers()
         loop.close()
@@ -22,6 +22,11 @@ Objects and tools for processing MIDI data.  Converts from MIDI files to
 This module uses routines from Will Ware's public domain midi.py library from 2001
 see http://groups.google.com/group/alt.sources/msg/0c5fc523e050c35e
 '''
+import mmap
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
 import struct
 import sys
 import unicodedata # @UnresolvedImport
@@ -216,6 +221,47 @@ def get_variable_length_number(midi_str):
                 break
     raise MidiException('did not find the end of the number!')
 
+def read_number(buf, pos, length):
+    '''
+    Return the big-endian number stored in the `length` bytes of `buf`
+    that start at `pos`, together with the position just after it.
+
+    Unlike :func:`get_number` this never copies the remainder of `buf`,
+    so it is safe to call in a loop over a `memoryview` of a whole file.
+
+    >>> read_number(b'\\x00\\x00\\x01\\x00MTrk', 0, 4)
+    (256, 4)
+    >>> read_number(memoryview(b'test'), 2, 2)
+    (29556, 4)
+    '''
+    return int.from_bytes(buf[pos:pos + length], 'big'), pos + length
+
+def read_variable_length_number(buf, pos, end=None):
+    r'''
+    Cursor based version of :func:`get_variable_length_number`: read a
+    variable length number from `buf` starting at `pos` and return it
+    with the position just after its last byte. Reading stops at `end`
+    (default: the end of `buf`).
+
+    >>> read_variable_length_number(b'\xff\x7fxy', 0)
+    (16383, 2)
+    >>> read_variable_length_number(memoryview(b'A-u'), 1)
+    (45, 2)
+    >>> read_variable_length_number(b'\x81\x80', 0)  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    MidiException: did not find the end of the number!
+    '''
+    if end is None:
+        end = len(buf)
+    summation = 0
+    while pos < end:
+        byte = buf[pos]
+        pos += 1
+        summation = (summation << 7) + (byte & 0x7F)
+        if not byte & 0x80:
+            return summation, pos
+    raise MidiException('did not find the end of the number!')
+
 def get_numbers_as_list(midi_str):
     '''
     Translate each char into a number, return in a list.
@@ -225,6 +271,8 @@ def get_numbers_as_list(midi_str):
     >>> get_numbers_as_list('\\x00\\x00\\x00\\x03')
     [0, 0, 0, 3]
     '''
+    if isinstance(midi_str, (bytes, bytearray)):
+        return list(midi_str)
     post = []
     for item in midi_str:
         if is_num(item):
@@ -281,6 +329,27 @@ def put_variable_length_number(num):
     lst[-1] = lst[-1] & 0x7f
     return bytes(lst)
 
+def write_variable_length_number(out, num):
+    '''
+    Append the variable length encoding of `num` to the bytearray `out`;
+    the in-place counterpart of :func:`put_variable_length_number`.
+
+    >>> out = bytearray(b'\\x90')
+    >>> write_variable_length_number(out, 16383)
+    >>> bytes(out)
+    b'\\x90\\xff\\x7f'
+    '''
+    if num < 0:
+        raise MidiException(
+            'cannot put_variable_length_number() when number is negative: %s' % num)
+    shift = 7
+    while num >> shift:
+        shift += 7
+    while shift > 7:
+        shift -= 7
+        out.append(((num >> shift) & 0x7F) | 0x80)
+    out.append(num & 0x7F)
+
 def put_numbers_as_list(num_list):
     '''
     Translate a list of numbers (0-255) into a bytestring.
@@ -309,6 +378,112 @@ def put_numbers_as_list(num_list):
         post.append(num)
     return bytes(post)
 
+def _event_tick(item):
+    return item[1]
+
+def merge_event_streams(streams):
+    '''
+    Merge per track streams of `(track_index, absolute_tick, event)` into
+    one stream ordered by tick, using a heap over the heads of the
+    streams. Events at the same tick come out in track order, and the
+    order within every track is kept.
+
+    >>> list(merge_event_streams([
+    ...     iter([(0, 0, 'tempo'), (0, 96, 'marker')]),
+    ...     iter([(1, 0, 'name'), (1, 48, 'note'), (1, 96, 'note off')])]))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [(0, 0, 'tempo'), (1, 0, 'name'), (1, 48, 'note'),
+     (0, 96, 'marker'), (1, 96, 'note off')]
+    '''
+    return merge(*streams, key=_event_tick)
+
+def scale_tempo(tempo, factor):
+    '''
+    Return the SET_TEMPO value (microseconds per quarter note) for a
+    tempo `factor` times as fast as `tempo`, kept within 3 bytes.
+
+    >>> scale_tempo(500000, 1.25)
+    400000
+    >>> scale_tempo(500000, 0.01)
+    16777215
+    '''
+    return min(max(int(round(tempo / factor)), 1), 0xFFFFFF)
+
+def scale_tempo_data(data, factor):
+    '''
+    Return the 3 data bytes of a SET_TEMPO event `factor` times as fast.
+
+    >>> scale_tempo_data(b'\\x07\\xa1\\x20', 1.25)
+    b'\\x06\\x1a\\x80'
+    '''
+    tempo, _ = read_number(data, 0, 3)
+    return put_number(scale_tempo(tempo, factor), 3)
+
+def transpose_table(semitones):
+    '''
+    Translation table from a pitch to the pitch `semitones` higher.
+    Pitches that would end up out of range map to 0xFF, see
+    `transpose_error`.
+
+    >>> table = transpose_table(2)
+    >>> len(table), table[60], table[125], table[126]
+    (128, 62, 127, 255)
+    '''
+    return bytes(
+        pitch + semitones if 0 <= pitch + semitones < 128 else 0xFF
+        for pitch in range(128))
+
+def transpose_error(pitch, semitones):
+    '''
+    The exception for a `pitch` that cannot be shifted by `semitones`.
+
+    >>> print(transpose_error(126, 2))
+    cannot transpose pitch 126 by 2 semitones
+    '''
+    return MidiException(
+        "cannot transpose pitch {} by {} semitones".format(pitch, semitones))
+
+def pair_notes(note_events, end_tick=None):
+    '''
+    Pair note ons with note offs in a single pass over
+    `(tick, is_note_on, channel, pitch, velocity)`, where `is_note_on` is
+    False for note offs and for note ons with velocity 0. Returns a list
+    of `(start_tick, end_tick, channel, pitch, velocity)` in order of
+    start.
+
+    Every channel and pitch has a stack of sounding notes, so a note off
+    ends the latest note that is still sounding. Note offs without a
+    sounding note are ignored, notes that are never ended last until
+    `end_tick`, by default the tick of the last note event.
+
+    >>> pair_notes([
+    ...     (0, True, 1, 60, 100), (0, True, 1, 64, 90), (96, False, 1, 60, 0),
+    ...     (96, False, 2, 64, 0), (96, True, 1, 60, 80), (192, False, 1, 64, 0)])
+    [(0, 96, 1, 60, 100), (0, 192, 1, 64, 90), (96, 192, 1, 60, 80)]
+    '''
+    notes = []
+    sounding = {}
+    tick = 0
+    for tick, is_note_on, channel, pitch, velocity in note_events:
+        key = (channel, pitch)
+        if is_note_on:
+            sounding.setdefault(key, []).append(len(notes))
+            # end tick is filled in by the note off
+            notes.append((tick, None, channel, pitch, velocity))
+        elif sounding.get(key):
+            i = sounding[key].pop()
+            notes[i] = (notes[i][0], tick) + notes[i][2:]
+    if end_tick is None:
+        end_tick = tick
+    for stack in sounding.values():
+        for i in stack:
+            notes[i] = (notes[i][0], end_tick) + notes[i][2:]
+    return notes
+
+def _tick_stream(events, track_index):
+    for time, _, event, _ in events:
+        yield track_index, time, event
+
 #-------------------------------------------------------------------------------
 class Enumeration(object):
     '''
@@ -412,6 +587,26 @@ META_EVENTS = Enumeration([
     ("KEY_SIGNATURE", 0x59),
     ("SEQUENCER_SPECIFIC_META_EVENT", 0x7F)])
 
+# Integer kinds for every `type_` string, so hot loops can compare ints.
+# Channel voice messages keep their status nybble, sysex events their
+# status byte; meta events are offset by 0x100 and channel mode
+# messages by 0x200.
+EVENT_KINDS = Enumeration(
+    [(name, value) for name, value in CHANNEL_VOICE_MESSAGES.lookup.items()] +
+    [("F0_SYSEX_EVENT", 0xF0), ("F7_SYSEX_EVENT", 0xF7)] +
+    [(name, 0x100 + value) for name, value in META_EVENTS.lookup.items()] +
+    [(name, 0x200 + value) for name, value in CHANNEL_MODE_MESSAGES.lookup.items()] +
+    [("DeltaTime", 0x300)])
+
+_NOTE_OFF = EVENT_KINDS.NOTE_OFF
+_NOTE_ON = EVENT_KINDS.NOTE_ON
+_PITCH_BEND = EVENT_KINDS.PITCH_BEND
+_PROGRAM_CHANGE = EVENT_KINDS.PROGRAM_CHANGE
+_CHANNEL_KEY_PRESSURE = EVENT_KINDS.CHANNEL_KEY_PRESSURE
+_DELTA_TIME = EVENT_KINDS.DeltaTime
+_SEQUENCE_TRACK_NAME = EVENT_KINDS.SEQUENCE_TRACK_NAME
+_SET_TEMPO = EVENT_KINDS.SET_TEMPO
+
 #-------------------------------------------------------------------------------
 class MidiEvent(object):
     '''
@@ -452,9 +647,12 @@ class MidiEvent(object):
     '''
     def __init__(self, track, type_=None, time=None, channel=None):
         self.track = track
-        self.type_ = type_
-        self.time = time
-        self.channel = channel
+        # set the fields behind the properties directly, a new event
+        # does not change the track it is created for
+        self._type = type_
+        self.kind = EVENT_KINDS.lookup.get(type_)
+        self._time = time
+        self._channel = channel
 
         self._parameter1 = None # pitch or first data value
         self._parameter2 = None # velocity or second data value
@@ -479,10 +677,48 @@ class MidiEvent(object):
         self.sort_order = 0
         self.update_sort_order()
 
+    def _mark_dirty(self):
+        if self.track is not None:
+            self.track.dirty = True
+
+    def _set_type(self, value):
+        if value != self._type:
+            self._mark_dirty()
+        self._type = value
+        self.kind = EVENT_KINDS.lookup.get(value)
+
+    def _get_type(self):
+        return self._type
+
+    # setting type_ keeps the integer `kind` in sync
+    type_ = property(_get_type, _set_type)
+
+    # changing any of the properties below marks the track dirty, so it
+    # is encoded again instead of copied, see MidiTrack.write_to()
+    def _set_time(self, value):
+        if value != self._time:
+            self._mark_dirty()
+        self._time = value
+
+    def _get_time(self):
+        return self._time
+
+    time = property(_get_time, _set_time)
+
+    def _set_channel(self, value):
+        if value != self._channel:
+            self._mark_dirty()
+        self._channel = value
+
+    def _get_channel(self):
+        return self._channel
+
+    channel = property(_get_channel, _set_channel)
+
     def update_sort_order(self):
-        if self.type_ == 'PITCH_BEND':
+        if self.kind == _PITCH_BEND:
             self.sort_order = -10
-        if self.type_ == 'NOTE_OFF':
+        if self.kind == _NOTE_OFF:
             self.sort_order = -20
 
     def __repr__(self):
@@ -494,7 +730,7 @@ class MidiEvent(object):
         return_str = ("<MidiEvent %s, t=%s, track=%s, channel=%s" %
              (self.type_, repr(self.time), track_index,
               repr(self.channel)))
-        if self.type_ in ['NOTE_ON', 'NOTE_OFF']:
+        if self.kind == _NOTE_ON or self.kind == _NOTE_OFF:
             attr_list = ["pitch", "velocity"]
         else:
             if self._parameter2 is None:
@@ -508,10 +744,12 @@ class MidiEvent(object):
         return return_str + ">"
 
     def _set_pitch(self, value):
+        if value != self._parameter1:
+            self._mark_dirty()
         self._parameter1 = value
 
     def _get_pitch(self):
-        if self.type_ in ['NOTE_ON', 'NOTE_OFF']:
+        if self.kind == _NOTE_ON or self.kind == _NOTE_OFF:
             return self._parameter1
         else:
             return None
@@ -519,6 +757,8 @@ class MidiEvent(object):
     pitch = property(_get_pitch, _set_pitch)
 
     def _set_velocity(self, value):
+        if value != self._parameter2:
+            self._mark_dirty()
         self._parameter2 = value
 
     def _get_velocity(self):
@@ -530,6 +770,8 @@ class MidiEvent(object):
         if value is not None and not isinstance(value, bytes):
             if isinstance(value, str):
                 value = value.encode('utf-8')
+        if value != self._parameter1:
+            self._mark_dirty()
         self._parameter1 = value
 
     def _get_data(self):
@@ -590,62 +832,10 @@ class MidiEvent(object):
         else:
             data2 = 0
 
+        self._mark_dirty()
         self._parameter1 = data2
         self._parameter2 = data1 # data1 is msb here
 
-    def _parse_channel_voice_message(self, midi_str):
-        '''
-
-        >>> mt = MidiTrack(1)
-        >>> me1 = MidiEvent(mt)
-        >>> remainder = me1._parse_channel_voice_message(ints_to_hex_string([144, 60, 120]))
-        >>> me1.channel
-        1
-        >>> remainder = me1._parse_channel_voice_message(ints_to_hex_string([145, 60, 120]))
-        >>> me1.channel
-        2
-        >>> me1.type_
-        'NOTE_ON'
-        >>> me1.pitch
-        60
-        >>> me1.velocity
-        120
-        '''
-        # first_byte, channel_number, and second_byte define
-        # characteristics of the first two chars
-        # for first_byte: The left nybble (4 bits) contains the actual command, and the right nibble
-        # contains the midi channel number on which the command will be executed.
-        if is_num(midi_str[0]):
-            first_byte = midi_str[0]
-        else:
-            first_byte = ord(midi_str[0])
-        channel_number = first_byte & 0xF0
-        if is_num(midi_str[1]):
-            second_byte = midi_str[1]
-        else:
-            second_byte = ord(midi_str[1])
-        if is_num(midi_str[2]):
-            third_byte = midi_str[2]
-        else:
-            third_byte = ord(midi_str[2])
-
-        self.channel = (first_byte & 0x0F) + 1
-        self.type_ = CHANNEL_VOICE_MESSAGES.whatis(channel_number)
-        if (self.type_ == "PROGRAM_CHANGE" or
-                self.type_ == "CHANNEL_KEY_PRESSURE"):
-            self.data = second_byte
-            return midi_str[2:]
-        elif self.type_ == "CONTROLLER_CHANGE":
-            # for now, do nothing with this data
-            # for a note, str[2] is velocity; here, it is the control value
-            self.pitch = second_byte # this is the controller id
-            self.velocity = third_byte # this is the controller value
-            return midi_str[3:]
-        else:
-            self.pitch = second_byte
-            self.velocity = third_byte
-            return midi_str[3:]
-
     def read(self, time, midi_str):
         '''
         Parse the string that is given and take the beginning
@@ -654,7 +844,10 @@ class MidiEvent(object):
         The `time` value is the number of ticks into the Track
         at which this event happens. This is derived from reading
         data the level of the track.
-        TODO: These instructions are inadequate.
+
+        This is a thin wrapper around :meth:`read_from`, which does the
+        actual work on a cursor instead of slicing.
+
         >>> # all note-on messages (144-159) can be found
         >>> 145 & 0xF0 # testing message type_ extraction
         144
@@ -664,8 +857,38 @@ class MidiEvent(object):
         1
         >>> (159 & 0x0F) + 1 # getting the channel
         16
+        >>> mt = MidiTrack(1)
+        >>> me1 = MidiEvent(mt)
+        >>> me1.read(0, ints_to_hex_string([146, 60, 120, 0]))
+        b'\\x00'
+        >>> me1
+        <MidiEvent NOTE_ON, t=None, track=1, channel=3, pitch=60, velocity=120>
         '''
-        if len(midi_str) < 2:
+        if isinstance(midi_str, str):
+            midi_str = midi_str.encode('utf-8')
+        pos = self.read_from(time, midi_str, 0, len(midi_str))
+        return midi_str[pos:]
+
+    def read_from(self, time, buf, pos, end):
+        '''
+        Parse a single event from `buf` (bytes or a memoryview) starting
+        at `pos` and return the position just after it. `end` is the end of
+        the enclosing track; nothing at or beyond it is read.
+
+        The buffer is never sliced apart from the data payload of
+        sysex and meta events, so parsing a track is linear in its size.
+        Running status is resolved through `last_status_byte` without
+        rebuilding the buffer.
+
+        >>> mt = MidiTrack(1)
+        >>> me1 = MidiEvent(mt)
+        >>> me1.last_status_byte = 0x91
+        >>> me1.read_from(0, b'\\x00\\x3c\\x40', 1, 3)
+        3
+        >>> me1
+        <MidiEvent NOTE_ON, t=None, track=1, channel=2, pitch=60, velocity=64>
+        '''
+        if end - pos < 2:
             # often what we have here are null events:
             # the string is simply: 0x00
             print(
@@ -673,148 +896,167 @@ class MidiEvent(object):
                 'time',
                 time,
                 'str',
-                repr(midi_str))
-            return ''
+                repr(bytes(buf[pos:end])))
+            return end
 
-        # first_byte, message_type, and second_byte define
-        # characteristics of the first two chars
-        # for first_byte: The left nybble (4 bits) contains the
+        # for the status byte: The left nybble (4 bits) contains the
         # actual command, and the right nibble
         # contains the midi channel number on which the command will
         # be executed.
-        if is_num(midi_str[0]):
-            first_byte = midi_str[0]
-        else:
-            first_byte = ord(midi_str[0])
+        first_byte = buf[pos]
 
         # detect running status: if the status byte is less than 128, its
-        # not a status byte, but a data byte
+        # not a status byte, but a data byte; the data starts right here
         if first_byte < 128:
             if self.last_status_byte is not None:
-                rsb = self.last_status_byte
-                if is_num(rsb):
-                    rsb = bytes([rsb])
+                first_byte = self.last_status_byte
             else:
-                rsb = bytes([0x90])
-            # add the running status byte to the front of the string
-            # and process as before
-            midi_str = rsb + midi_str
-            if is_num(midi_str[0]):
-                first_byte = midi_str[0]
-            else:
-                first_byte = ord(midi_str[0])
-        else:
-            self.last_status_byte = midi_str[0]
-
-        message_type = first_byte & 0xF0
-
-        if is_num(midi_str[1]):
-            second_byte = midi_str[1]
+                first_byte = 0x90
+            data_pos = pos
         else:
-            second_byte = ord(midi_str[1])
-
-        if CHANNEL_VOICE_MESSAGES.has_value(message_type):
-            return self._parse_channel_voice_message(midi_str)
-
-        elif message_type == 0xB0 and CHANNEL_MODE_MESSAGES.has_value(second_byte):
-            self.channel = (first_byte & 0x0F) + 1
-            self.type_ = CHANNEL_MODE_MESSAGES.whatis(second_byte)
-            if self.type_ == "LOCAL_CONTROL":
-                self.data = (ord(midi_str[2]) == 0x7F)
-            elif self.type_ == "MONO_MODE_ON":
-                self.data = ord(midi_str[2])
-            else:
-                print('unhandled message:', midi_str[2])
-            return midi_str[3:]
+            self.last_status_byte = first_byte
+            data_pos = pos + 1
 
-        elif first_byte == 0xF0 or first_byte == 0xF7:
-            self.type_ = {0xF0: "F0_SYSEX_EVENT",
-                         0xF7: "F7_SYSEX_EVENT"}[first_byte]
-            length, midi_str = get_variable_length_number(midi_str[1:])
-            self.data = midi_str[:length]
-            return midi_str[length:]
-
-        # SEQUENCE_TRACK_NAME and other MetaEvents are here
-        elif first_byte == 0xFF:
-            if not META_EVENTS.has_value(second_byte):
-                print("unknown meta event: FF %02X" % second_byte)
-                sys.stdout.flush()
-                raise MidiException("Unknown midi event type_: %r, %r" % (first_byte, second_byte))
-            self.type_ = META_EVENTS.whatis(second_byte)
-            length, midi_str = get_variable_length_number(midi_str[2:])
-            self.data = midi_str[:length]
-            return midi_str[length:]
-        else:
+        entry = _STATUS_TABLE[first_byte]
+        if entry is None:
             # an uncaught message
             print(
                 'got unknown midi event type_',
                 repr(first_byte),
                 'char_to_binary(midi_str[0])',
-                char_to_binary(midi_str[0]),
+                char_to_binary(chr(first_byte)),
                 'char_to_binary(midi_str[1])',
-                char_to_binary(midi_str[1]))
+                char_to_binary(chr(buf[data_pos])))
             raise MidiException("Unknown midi event type_")
-
+        return entry[4](self, entry, buf, data_pos, end)
+
+    def _read_channel_message(self, entry, buf, pos, end):
+        self._type, self.kind, self._channel, length, _ = entry
+        if pos + length > end:
+            raise MidiException("truncated %s event" % self._type)
+        # for a CONTROLLER_CHANGE these are the controller
+        # id and value instead of pitch and velocity
+        self._parameter1 = buf[pos]
+        if length == 2:
+            self._parameter2 = buf[pos + 1]
+        return pos + length
+
+    def _read_sysex(self, entry, buf, pos, end):
+        self._type, self.kind = entry[0], entry[1]
+        length, pos = read_variable_length_number(buf, pos, end)
+        self._parameter1 = bytes(buf[pos:min(pos + length, end)])
+        return pos + length
+
+    def _read_meta(self, _entry, buf, pos, end):
+        # SEQUENCE_TRACK_NAME and other MetaEvents are here
+        meta = _META_TABLE[buf[pos]]
+        if meta is None:
+            print("unknown meta event: FF %02X" % buf[pos])
+            sys.stdout.flush()
+            raise MidiException("Unknown midi event type_: %r, %r" % (0xFF, buf[pos]))
+        self._type, self.kind = meta
+        length, pos = read_variable_length_number(buf, pos + 1, end)
+        self._parameter1 = bytes(buf[pos:min(pos + length, end)])
+        return pos + length
 
     def get_bytes(self):
         '''
         Return a set of bytes for this MIDI event.
+
+        >>> mt = MidiTrack(1)
+        >>> me1 = MidiEvent(mt, type_="NOTE_ON", channel=2)
+        >>> me1.pitch = 60
+        >>> me1.velocity = 120
+        >>> me1.get_bytes()
+        b'\\x91<x'
         '''
-        sysex_event_dict = {"F0_SYSEX_EVENT": 0xF0,
-                            "F7_SYSEX_EVENT": 0xF7}
-        if CHANNEL_VOICE_MESSAGES.hasattr(self.type_):
-            return_bytes = chr((self.channel - 1) +
-                    getattr(CHANNEL_VOICE_MESSAGES, self.type_))
-            # for writing note-on/note-off
-            if self.type_ not in [
-                    'PROGRAM_CHANGE', 'CHANNEL_KEY_PRESSURE']:
-                # this results in a two-part string, like '\x00\x00'
-                try:
-                    data = chr(self._parameter1) + chr(self._parameter2)
-                except ValueError:
-                    raise MidiException(
-                        "Problem with representing either %d or %d" % (
-                            self._parameter1, self._parameter2))
-            elif self.type_ in ['PROGRAM_CHANGE']:
-                try:
-                    data = chr(self.data)
-                except TypeError:
-                    raise MidiException(
-                        "Got incorrect data for %return_bytes in .data: %return_bytes," %
-                            (self, self.data) + "cannot parse Program Change")
-            else:
-                try:
-                    data = chr(self.data)
-                except TypeError:
-                    raise MidiException(
-                        ("Got incorrect data for %return_bytes in "
-                         ".data: %return_bytes, ") % (self, self.data) +
-                        "cannot parse Miscellaneous Message")
-            return return_bytes + data
-
-        elif CHANNEL_MODE_MESSAGES.hasattr(self.type_):
-            return_bytes = getattr(CHANNEL_MODE_MESSAGES, self.type_)
-            return_bytes = (chr(0xB0 + (self.channel - 1)) +
-                 chr(return_bytes) +
-                 chr(self.data))
-            return return_bytes
-
-        elif self.type_ in sysex_event_dict:
-            return_bytes = bytes([sysex_event_dict[self.type_]])
-            return_bytes = return_bytes + put_variable_length_number(len(self.data))
-            return return_bytes + self.data
-
-        elif META_EVENTS.hasattr(self.type_):
-            return_bytes = bytes([0xFF]) + bytes([getattr(META_EVENTS, self.type_)])
-            return_bytes = return_bytes + put_variable_length_number(len(self.data))
+        out = bytearray()
+        self.write_to(out)
+        return bytes(out)
+
+    def write_to(self, out, running_status=None):
+        '''
+        Append the bytes for this MIDI event to the bytearray `out`.
+        Nothing is appended if the event cannot be represented.
+
+        To write with running status, pass the status returned for the
+        previous event of the track as `running_status`, or 0 for the
+        first one. A status byte equal to it is then left out, and
+        NOTE_OFF is written as NOTE_ON with velocity 0 so it can share
+        the status of the notes around it. The return value is the
+        running status after this event.
+
+        >>> mt = MidiTrack(1)
+        >>> out = bytearray()
+        >>> status = 0
+        >>> for type_, velocity in [("NOTE_ON", 100), ("NOTE_OFF", 64), ("NOTE_ON", 90)]:
+        ...     me = MidiEvent(mt, type_=type_, channel=1)
+        ...     me.pitch, me.velocity = 60, velocity
+        ...     status = me.write_to(out, status)
+        >>> bytes(out)
+        b'\\x90<d<\\x00<Z'
+        '''
+        mark = len(out)
+        try:
+            return self._write_to(out, running_status)
+        except (TypeError, ValueError):
+            del out[mark:]
+            raise MidiException(
+                "Problem with representing %r, data: %r, %r" % (
+                    self, self._parameter1, self._parameter2))
+
+    def _write_to(self, out, running_status=None):
+        kind = self.kind
+        if kind is None or kind == _DELTA_TIME:
+            raise MidiException("unknown midi event type_: %s" % self.type_)
+
+        elif kind >= 0x200:
+            # channel mode message
+            status = 0xB0 + (self.channel - 1)
+            if status != running_status:
+                out.append(status)
+            out.append(kind - 0x200)
+            out.append(self.data)
+            return status
+
+        elif kind >= 0x100:
+            # meta event
+            data = self.data
+            if not isinstance(data, (bytes, bytearray)):
+                data = unicodedata.normalize(
+                    'NFKD', data).encode('ascii', 'ignore')
+            out.append(0xFF)
+            out.append(kind - 0x100)
+            write_variable_length_number(out, len(data))
+            out.extend(data)
+            # meta and sysex events cancel running status
+            return 0
+
+        elif kind == 0xF0 or kind == 0xF7:
+            out.append(kind)
+            write_variable_length_number(out, len(self.data))
+            out.extend(self.data)
+            return 0
+
+        elif kind == _NOTE_OFF and running_status is not None:
+            status = (self.channel - 1) + _NOTE_ON
+            if status != running_status:
+                out.append(status)
+            out.append(self._parameter1)
+            out.append(0)
+            return status
 
-            try:
-                return return_bytes + self.data
-            except (UnicodeDecodeError, TypeError):
-                return return_bytes + unicodedata.normalize(
-                    'NFKD', self.data).encode('ascii', 'ignore')
         else:
-            raise MidiException("unknown midi event type_: %return_bytes" % self.type_)
+            status = (self.channel - 1) + kind
+            if status != running_status:
+                out.append(status)
+            # for writing note-on/note-off
+            if kind != _PROGRAM_CHANGE and kind != _CHANNEL_KEY_PRESSURE:
+                out.append(self._parameter1)
+                out.append(self._parameter2)
+            else:
+                out.append(self.data)
+            return status
 
     #---------------------------------------------------------------------------
     def is_note_on(self):
@@ -830,7 +1072,7 @@ class MidiEvent(object):
         >>> me1.is_note_off()
         False
         '''
-        return self.type_ == "NOTE_ON" and self.velocity != 0
+        return self.kind == _NOTE_ON and self.velocity != 0
 
     def is_note_off(self):
         '''
@@ -852,9 +1094,9 @@ class MidiEvent(object):
         >>> me2.is_note_off()
         True
         '''
-        if self.type_ == "NOTE_OFF":
+        if self.kind == _NOTE_OFF:
             return True
-        elif self.type_ == "NOTE_ON" and self.velocity == 0:
+        elif self.kind == _NOTE_ON and self.velocity == 0:
             return True
         return False
 
@@ -867,9 +1109,7 @@ class MidiEvent(object):
         >>> dt.is_delta_time()
         True
         '''
-        if self.type_ == "DeltaTime":
-            return True
-        return False
+        return self.kind == _DELTA_TIME
 
     def matched_note_off(self, other):
         '''
@@ -901,8 +1141,13 @@ class MidiEvent(object):
         >>> me2.channel = 12
         >>> me1.matched_note_off(me2)
         False
+        >>> me2.channel = None
+        >>> me2.type_ = "NOTE_ON"
+        >>> me2.velocity = 100
+        >>> me1.matched_note_off(me2)
+        False
         '''
-        if other.is_note_off:
+        if other.is_note_off():
             # might check velocity here too?
             if self.pitch == other.pitch and self.channel == other.channel:
                 return True
@@ -926,16 +1171,87 @@ class DeltaTime(MidiEvent):
     '''
     def __init__(self, track, time=None, channel=None):
         MidiEvent.__init__(self, track, time=time, channel=channel)
-        self.type_ = "DeltaTime"
+        self._type = "DeltaTime"
+        self.kind = _DELTA_TIME
 
     def read(self, oldstr):
         self.time, newstr = get_variable_length_number(oldstr)
         return self.time, newstr
 
+    def read_from(self, buf, pos, end=None):
+        self._time, pos = read_variable_length_number(buf, pos, end)
+        return self._time, pos
+
     def get_bytes(self):
         midi_str = put_variable_length_number(self.time)
         return midi_str
 
+    def write_to(self, out, running_status=None):
+        write_variable_length_number(out, self.time)
+        return running_status
+
+def _build_status_table():
+    '''
+    Build the 256 entry decoder table, indexed by status byte. Every entry
+    is `(type_, kind, channel, data_length, handler)`, or None for status
+    bytes that cannot start an event.
+    '''
+    table = [None] * 256
+    for type_, kind in CHANNEL_VOICE_MESSAGES.lookup.items():
+        length = 1 if type_ in ("PROGRAM_CHANGE", "CHANNEL_KEY_PRESSURE") else 2
+        for channel in range(16):
+            table[kind + channel] = (
+                type_, kind, channel + 1, length,
+                MidiEvent._read_channel_message) # pylint: disable=protected-access
+    for type_ in ("F0_SYSEX_EVENT", "F7_SYSEX_EVENT"):
+        kind = EVENT_KINDS.lookup[type_]
+        table[kind] = (
+            type_, kind, None, None,
+            MidiEvent._read_sysex) # pylint: disable=protected-access
+    table[0xFF] = (
+        None, None, None, None,
+        MidiEvent._read_meta) # pylint: disable=protected-access
+    return table
+
+_STATUS_TABLE = _build_status_table()
+# (type_, kind) by meta event type byte
+_META_TABLE = [
+    (META_EVENTS.whatis(value), EVENT_KINDS.lookup[META_EVENTS.whatis(value)])
+    if META_EVENTS.has_value(value) else None
+    for value in range(256)]
+
+class EventList(list):
+    '''
+    The `events` list of a :class:`~base.MidiTrack`. Works like a plain
+    list, but every change to it marks the track dirty.
+
+    >>> mt = MidiTrack(1)
+    >>> mt.dirty = False
+    >>> mt.events.append(DeltaTime(mt, time=0))
+    >>> mt.dirty
+    True
+    '''
+    __slots__ = ('track',)
+
+    def __init__(self, track, events=()):
+        list.__init__(self, events)
+        self.track = track
+
+def _marks_dirty(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        self.track.dirty = True
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+for _name in (
+        'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort',
+        'reverse', '__setitem__', '__delitem__', '__iadd__', '__imul__'):
+    setattr(EventList, _name, _marks_dirty(_name))
+del _name
+
 class MidiTrack(object):
     '''
     A MIDI Track. Each track contains a list of
@@ -944,13 +1260,38 @@ class MidiTrack(object):
     An `index` is an integer identifier for this object.
     TODO: Better Docs
 
-    >>> mt = MidiTrack(0)
+    A track that was read keeps its chunk in `raw`. As long as neither
+    the `events` list nor any of the events change, `dirty` stays False
+    and writing copies `raw` instead of encoding the events again.
 
+    >>> mt = MidiTrack(0)
+    >>> mt.read(b"MTrk\\x00\\x00\\x00\\x07\\x00\\x90\\x3c\\x40\\x60\\x3c\\x00")
+    b''
+    >>> mt.dirty
+    False
+    >>> mt.get_bytes() == mt.raw
+    True
+    >>> mt.events[3].velocity = 1
+    >>> mt.dirty
+    True
+    >>> mt.get_bytes()
+    b'MTrk\\x00\\x00\\x00\\x08\\x00\\x90<@`\\x90<\\x01'
     '''
     def __init__(self, index):
         self.index = index
-        self.events = []
+        self._events = EventList(self)
         self.length = 0 #the data length; only used on read()
+        # the chunk as read, written out again as long as not dirty
+        self.raw = None
+        # bumped whenever the track is marked dirty, see dirty
+        self.changes = 0
+        self._dirty = True
+
+        # absolute tick of every non DeltaTime event and its position
+        # in .events; see build_tick_index()
+        self.tick_index = array('L')
+        self.tick_positions = array('L')
+        self._indexed_changes = 0
 
     def read(self, midi_str):
         '''
@@ -960,24 +1301,85 @@ class MidiTrack(object):
         Creates and stores :class:`~base.DeltaTime`
         and :class:`~base.MidiEvent` objects.
         '''
-        time = 0 # a running counter of ticks
+        with memoryview(midi_str) as buf:
+            pos = self.read_from(buf, 0)
+        return midi_str[pos:] # remainder string after extracting track data
+
+    def _get_events(self):
+        return self._events
+
+    def _set_events(self, events):
+        self._events = EventList(self, events)
+        self.dirty = True
+
+    # always an EventList, so changes to the list mark the track dirty
+    events = property(_get_events, _set_events)
+
+    def _get_dirty(self):
+        return self._dirty
 
-        if not midi_str[:4] == b"MTrk":
+    def _set_dirty(self, value):
+        if value:
+            # every change to the events or the list ends up here, so
+            # the tick index can tell whether it is out of date
+            self.changes += 1
+        self._dirty = value
+
+    dirty = property(_get_dirty, _set_dirty)
+
+    def read_from(self, buf, pos):
+        '''
+        Read the track chunk that starts at `pos` in `buf` and return the
+        position just after it. `buf` should be a memoryview (or bytes) of
+        the whole file; it is walked with a cursor and never copied, so
+        reading is linear in the size of the track.
+        The chunk itself is kept in `.raw`, unless events were added to
+        the track before.
+        '''
+        start = pos
+        pos, end = self.read_chunk_header(buf, pos)
+        clean = not self._events
+        events = list(self._events)
+        for time, delta_t, event, _ in self.iter_events_from(buf, pos, end):
+            events.append(delta_t)
+            events.append(event)
+            self.tick_index.append(time)
+            self.tick_positions.append(len(events) - 1)
+        self.events = events
+        self._indexed_changes = self.changes
+        if clean:
+            # a copy, so a memory mapped file can be closed afterwards
+            self.raw = bytes(buf[start:end])
+            self.dirty = False
+        return end
+
+    def read_chunk_header(self, buf, pos):
+        '''
+        Check the `MTrk` chunk header at `pos` and store its length.
+        Return the positions of the first and one past the last byte of
+        event data.
+        '''
+        if not buf[pos:pos + 4] == b"MTrk":
             raise MidiException('badly formed midi string: missing leading MTrk')
         # get the 4 chars after the MTrk encoding
-        length, midi_str = get_number(midi_str[4:], 4)
+        length, pos = read_number(buf, pos + 4, 4)
         self.length = length
+        return pos, pos + length
 
-        # all event data is in the track str
-        track_str = midi_str[:length]
-        remainder = midi_str[length:]
-
+    def iter_events_from(self, buf, pos, end):
+        '''
+        Lazily parse the event data between `pos` and `end`, yielding
+        `(absolute_tick, delta_time, event, next_pos)` for every event as
+        soon as it has been read, where `next_pos` is the position just
+        after the event. Nothing is stored on the track.
+        '''
+        time = 0 # a running counter of ticks
         e_previous = None
-        while track_str:
+        while pos < end:
             # shave off the time stamp from the event
             delta_t = DeltaTime(self)
-            # return extracted time, as well as remaining string
-            d_time, track_str_candidate = delta_t.read(track_str)
+            # return extracted time, as well as the new position
+            d_time, pos_candidate = delta_t.read_from(buf, pos, end)
             # this is the offset that this event happens at, in ticks
             time_candidate = time + d_time
 
@@ -987,43 +1389,50 @@ class MidiTrack(object):
                 event.last_status_byte = e_previous.last_status_byte
             # some midi events may raise errors; simply skip for now
             try:
-                track_str_candidate = event.read(time_candidate, track_str_candidate)
+                pos_candidate = event.read_from(time_candidate, buf, pos_candidate, end)
             except MidiException:
-                # assume that track_str, after delta extraction, is still correct
-                # set to result after taking delta time
-                track_str = track_str_candidate
+                # assume that the position after delta extraction is still correct
+                pos = pos_candidate
                 continue
             # only set after trying to read, which may raise exception
             time = time_candidate
-            track_str = track_str_candidate # remainder string
-            # only append if we get this far
-            self.events.append(delta_t)
-            self.events.append(event)
+            pos = pos_candidate
+            # only yield if we get this far
             e_previous = event
+            yield time, delta_t, event, pos
 
-        return remainder # remainder string after extracting track data
-
-    def get_bytes(self):
+    def get_bytes(self, running_status=False):
         '''
         returns a string of midi-data from the `.events` in the object.
         '''
-        # build str using MidiEvents
-        midi_str = b""
+        out = bytearray()
+        self.write_to(out, running_status)
+        return bytes(out)
+
+    def write_to(self, out, running_status=False):
+        '''
+        Append this track as an `MTrk` chunk to the bytearray `out`.
+        A clean track that was read is copied from `.raw`. Otherwise all
+        events are encoded straight into `out`; the chunk length is
+        filled in afterwards. With `running_status` repeated status bytes
+        are left out, see :meth:`MidiEvent.write_to`.
+        '''
+        if not self.dirty:
+            out.extend(self.raw)
+            return
+        start = len(out)
+        out.extend(b"MTrk\x00\x00\x00\x00")
+        status = 0 if running_status else None
         for event in self.events:
             # this writes both delta time and message events
             try:
-                event_bytes = event.get_bytes()
-                int_array = []
-                for byte in event_bytes:
-                    if is_num(byte):
-                        int_array.append(byte)
-                    else:
-                        int_array.append(ord(byte))
-                event_bytes = bytes(bytearray(int_array))
-                midi_str = midi_str + event_bytes
+                written = event.write_to(out, status)
             except MidiException as err:
                 print("Conversion error for %s: %s; ignored." % (event, err))
-        return b"MTrk" + put_number(len(midi_str), 4) + midi_str
+            else:
+                if running_status:
+                    status = written
+        out[start + 4:start + 8] = put_number(len(out) - start - 8, 4)
 
     def __repr__(self):
         return_str = "<MidiTrack %d -- %d events\n" % (self.index, len(self.events))
@@ -1032,6 +1441,81 @@ class MidiTrack(object):
         return return_str + "  >"
 
     #---------------------------------------------------------------------------
+    def build_tick_index(self):
+        '''
+        (Re)build `.tick_index` and `.tick_positions` from `.events`.
+        This happens while reading; the query methods below also call it
+        when the events or the list changed since.
+        '''
+        self.tick_index = array('L')
+        self.tick_positions = array('L')
+        tick = 0
+        for position, event in enumerate(self.events):
+            if event.is_delta_time():
+                tick += event.time
+            else:
+                self.tick_index.append(tick)
+                self.tick_positions.append(position)
+        self._indexed_changes = self.changes
+
+    def _check_tick_index(self):
+        if self._indexed_changes != self.changes:
+            self.build_tick_index()
+
+    def event_index(self, tick):
+        '''
+        Return the number of events (DeltaTime not counted) that happen
+        before `tick`, so `.tick_positions[mt.event_index(tick)]` is the
+        position of the first event at or after `tick`.
+        '''
+        self._check_tick_index()
+        return bisect_left(self.tick_index, tick)
+
+    def events_at(self, tick):
+        '''
+        Return all events that happen at exactly `tick`.
+
+        >>> mt = MidiTrack(1)
+        >>> mt.events = [
+        ...     DeltaTime(mt, time=0), MidiEvent(mt, type_="SET_TEMPO"),
+        ...     DeltaTime(mt, time=96), MidiEvent(mt, type_="MARKER"),
+        ...     DeltaTime(mt, time=0), MidiEvent(mt, type_="LYRIC"),
+        ...     DeltaTime(mt, time=96), MidiEvent(mt, type_="END_OF_TRACK")]
+        >>> [event.type_ for event in mt.events_at(96)]
+        ['MARKER', 'LYRIC']
+        >>> mt.events_at(10)
+        []
+        >>> mt.events[2].time = 10
+        >>> [event.type_ for event in mt.events_at(10)]
+        ['MARKER', 'LYRIC']
+        >>> mt.events[4:6] = [DeltaTime(mt, time=86), MidiEvent(mt, type_="LYRIC")]
+        >>> [event.type_ for event in mt.events_at(96)]
+        ['LYRIC']
+        '''
+        self._check_tick_index()
+        low = bisect_left(self.tick_index, tick)
+        high = bisect_right(self.tick_index, tick, low)
+        return [self.events[position] for position in self.tick_positions[low:high]]
+
+    def slice(self, tick_from, tick_to):
+        '''
+        Return all events with `tick_from <= tick < tick_to`.
+
+        >>> mt = MidiTrack(1)
+        >>> mt.events = [
+        ...     DeltaTime(mt, time=0), MidiEvent(mt, type_="SET_TEMPO"),
+        ...     DeltaTime(mt, time=96), MidiEvent(mt, type_="MARKER"),
+        ...     DeltaTime(mt, time=96), MidiEvent(mt, type_="END_OF_TRACK")]
+        >>> [event.type_ for event in mt.slice(1, 192)]
+        ['MARKER']
+        >>> [event.type_ for event in mt.slice(0, 1000)]
+        ['SET_TEMPO', 'MARKER', 'END_OF_TRACK']
+        '''
+        self._check_tick_index()
+        low = bisect_left(self.tick_index, tick_from)
+        high = bisect_left(self.tick_index, tick_to, low)
+        return [self.events[position] for position in self.tick_positions[low:high]]
+
     def update_events(self):
         '''
         We may attach events to this track before setting their `track` parameter.
@@ -1040,6 +1524,38 @@ class MidiTrack(object):
         for event in self.events:
             event.track = self
 
+    def get_notes(self):
+        '''
+        Return `(start_tick, end_tick, channel, pitch, velocity)` for all
+        notes in this track, see :func:`pair_notes`.
+
+        >>> mt = MidiTrack(1)
+        >>> for time, type_, velocity in [
+        ...         (0, "NOTE_ON", 100), (96, "NOTE_OFF", 64), (0, "END_OF_TRACK", None)]:
+        ...     me = MidiEvent(mt, type_=type_, channel=1)
+        ...     me.pitch, me.velocity = 60, velocity
+        ...     mt.events += [DeltaTime(mt, time=time), me]
+        >>> mt.get_notes()
+        [(0, 96, 1, 60, 100)]
+        '''
+        self._check_tick_index()
+        return pair_notes(
+            self._iter_note_events(),
+            self.tick_index[-1] if self.tick_index else 0)
+
+    def _iter_note_events(self):
+        events = self.events
+        for tick, position in zip(self.tick_index, self.tick_positions):
+            event = events[position]
+            if event.kind == _NOTE_ON or event.kind == _NOTE_OFF:
+                # pylint: disable=protected-access
+                yield (
+                    tick,
+                    event.kind == _NOTE_ON and event._parameter2 != 0,
+                    event.channel,
+                    event._parameter1,
+                    event._parameter2)
+
     def has_notes(self):
         '''Return True/False if this track has any note-on/note-off pairs defined.
         '''
@@ -1084,20 +1600,29 @@ class MidiFile(object):
 
     def __init__(self):
         self.file = None
+        self.mapping = None
         self.format = 1
         self.tracks = []
         self.ticks_per_quarter_note = 1024
         self.ticks_per_second = None
 
-    def open(self, filename, attrib="rb"):
+    def open(self, filename, attrib="rb", use_mmap=False):
         '''
         Open a MIDI file path for reading or writing.
 
         For writing to a MIDI file, `attrib` should be "wb".
+
+        With `use_mmap` a file opened for reading is memory mapped, and
+        `.read()` and `.iter_events()` parse straight from the mapped pages
+        instead of reading a private copy of the file. Repeated opens of
+        the same file then share the page cache.
         '''
         if attrib not in ['rb', 'wb']:
             raise MidiException('cannot read or write unless in binary mode, not:', attrib)
         self.file = open(filename, attrib)
+        if use_mmap and attrib == 'rb' and os.fstat(self.file.fileno()).st_size > 0:
+            self.mapping = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
 
     def open_file_like(self, file_like):
         '''Assign a file-like object, such as those provided by StringIO, as an open file object.
@@ -1118,14 +1643,61 @@ class MidiFile(object):
     def close(self):
         '''
         Close the file.
+
+        The parse methods release their views of a memory mapped file
+        when they finish, fail or are closed. If a view is still in use,
+        for instance by a half consumed :meth:`iter_events` generator,
+        the mapping is left to be closed by the garbage collector, so
+        `close()` is always safe in a `finally`.
+
+        >>> import tempfile
+        >>> out = MidiFile()
+        >>> for i in range(2):
+        ...     mt = MidiTrack(i)
+        ...     marker = MidiEvent(mt, type_="MARKER")
+        ...     marker.data = 'here'
+        ...     mt.events = [DeltaTime(mt, time=0), marker]
+        ...     out.tracks.append(mt)
+        >>> midi_str = out.writestr()
+        >>> second = midi_str.rindex(b'MTrk')
+        >>> midi_file = tempfile.NamedTemporaryFile(suffix='.midi')
+        >>> _ = midi_file.write(midi_str[:second] + b'MTrX' + midi_str[second + 4:])
+        >>> midi_file.flush()
+        >>> mf = MidiFile()
+        >>> mf.open(midi_file.name, use_mmap=True)
+        >>> try:
+        ...     for item in mf.iter_events():
+        ...         print(item)
+        ... except MidiException as err:
+        ...     print(err)
+        (0, 0, <MidiEvent MARKER, t=None, track=0, channel=None, data=b'here'>)
+        badly formed midi string: missing leading MTrk
+        >>> mf.close()
+        >>> mf = MidiFile()
+        >>> mf.open(midi_file.name, use_mmap=True)
+        >>> events = mf.iter_events()
+        >>> next(events)[1]
+        0
+        >>> mf.close()
+        >>> midi_file.close()
         '''
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # still viewed, closed when the last view is collected
+                pass
+            self.mapping = None
         self.file.close()
 
     def read(self):
         '''
         Read and parse MIDI data stored in a file.
         '''
-        self.readstr(self.file.read())
+        if self.mapping is not None:
+            self.readstr(self.mapping)
+        else:
+            self.readstr(self.file.read())
 
     def readstr(self, midi_str):
         '''
@@ -1133,22 +1705,36 @@ class MidiFile(object):
         data in `.ticks_per_quarter_note` and a list of
         `MidiTrack` objects in the attribute `.tracks`.
         '''
-        if not midi_str[:4] == b"MThd":
-            raise MidiException('badly formated midi string, got: %s' % midi_str[:20])
+        # released on errors too, so a memory mapped file can be closed
+        with memoryview(midi_str) as buf:
+            num_tracks, pos = self.read_header(buf)
+            for i in range(num_tracks):
+                trk = MidiTrack(i) # sets the MidiTrack index parameters
+                pos = trk.read_from(buf, pos) # continue right after this track
+                self.tracks.append(trk)
+
+    def read_header(self, buf):
+        '''
+        Parse the `MThd` chunk at the start of `buf`, setting `.format` and
+        the time division. Return the number of tracks and the position
+        of the first track chunk.
+        '''
+        if not buf[:4] == b"MThd":
+            raise MidiException('badly formated midi string, got: %s' % bytes(buf[:20]))
 
-        # we step through the str src, chopping off characters as we go
-        # and reassigning to str
-        length, midi_str = get_number(midi_str[4:], 4)
+        # we step through the buffer with a cursor instead of
+        # chopping off characters as we go
+        length, pos = read_number(buf, 4, 4)
         if length != 6:
             raise MidiException('badly formated midi string')
 
-        midi_format_type, midi_str = get_number(midi_str, 2)
+        midi_format_type, pos = read_number(buf, pos, 2)
         self.format = midi_format_type
         if midi_format_type not in (0, 1):
             raise MidiException('cannot handle midi file format: %s' % format)
 
-        num_tracks, midi_str = get_number(midi_str, 2)
-        division, midi_str = get_number(midi_str, 2)
+        num_tracks, pos = read_number(buf, pos, 2)
+        division, pos = read_number(buf, pos, 2)
 
         # very few midi files seem to define ticks_per_second
         if division & 0x8000:
@@ -1161,27 +1747,134 @@ class MidiFile(object):
             self.ticks_per_second = ticks_per_frame * frames_per_second
         else:
             self.ticks_per_quarter_note = division & 0x7FFF
+        return num_tracks, pos
 
+    def iter_events(self):
+        '''
+        Lazily read the file opened with `.open()`, yielding
+        `(track_index, absolute_tick, event)` for every event.
+        Only one track chunk is held in memory at a time and `.tracks`
+        is left untouched.
+        '''
+        if self.mapping is not None:
+            for item in self.iter_events_str(self.mapping):
+                yield item
+            return
+        num_tracks, _ = self.read_header(self.file.read(14))
         for i in range(num_tracks):
-            trk = MidiTrack(i) # sets the MidiTrack index parameters
-            midi_str = trk.read(midi_str) # pass all the remaining string, reassing
-            self.tracks.append(trk)
+            trk = MidiTrack(i)
+            trk.read_chunk_header(self.file.read(8), 0)
+            data = memoryview(self.file.read(trk.length))
+            for time, _, event, _ in trk.iter_events_from(data, 0, len(data)):
+                yield i, time, event
+
+    def iter_events_str(self, midi_str):
+        '''
+        Like :meth:`iter_events`, but for MIDI data given as a string.
+
+        >>> mf = MidiFile()
+        >>> mt = MidiTrack(0)
+        >>> me = MidiEvent(mt, type_="NOTE_ON", channel=1)
+        >>> me.pitch, me.velocity = 60, 100
+        >>> mt.events = [DeltaTime(mt, time=96), me]
+        >>> mf.tracks.append(mt)
+        >>> for item in MidiFile().iter_events_str(mf.writestr()):
+        ...     print(item)
+        (0, 96, <MidiEvent NOTE_ON, t=None, track=0, channel=1, pitch=60, velocity=100>)
+        '''
+        with memoryview(midi_str) as buf:
+            num_tracks, pos = self.read_header(buf)
+            for i in range(num_tracks):
+                trk = MidiTrack(i)
+                pos, end = trk.read_chunk_header(buf, pos)
+                for time, _, event, _ in trk.iter_events_from(buf, pos, end):
+                    yield i, time, event
+                pos = end
+
+    def iter_merged_events(self):
+        '''
+        Like :meth:`iter_events`, but with the events of all tracks merged
+        into one stream ordered by absolute tick (for format 1 files).
+        All tracks are read concurrently, so unless the file was opened
+        with `use_mmap` it is read into memory first.
+        '''
+        if self.mapping is not None:
+            return self.iter_merged_events_str(self.mapping)
+        return self.iter_merged_events_str(self.file.read())
 
-    def write(self):
+    def iter_merged_events_str(self, midi_str):
+        '''
+        Like :meth:`iter_merged_events`, but for MIDI data given as a string.
+        '''
+        with memoryview(midi_str) as buf:
+            num_tracks, pos = self.read_header(buf)
+            streams = []
+            for i in range(num_tracks):
+                trk = MidiTrack(i)
+                pos, end = trk.read_chunk_header(buf, pos)
+                streams.append(_tick_stream(trk.iter_events_from(buf, pos, end), i))
+                pos = end
+            for item in merge_event_streams(streams):
+                yield item
+
+    def merged_events(self):
+        '''
+        Return the events of the parsed `.tracks` as one stream of
+        `(track_index, absolute_tick, event)` ordered by tick.
+
+        >>> mf = MidiFile()
+        >>> for i, times in enumerate([(0, 96), (48,)]):
+        ...     mt = MidiTrack(i)
+        ...     for time in times:
+        ...         mt.events += [DeltaTime(mt, time=time), MidiEvent(mt, type_="MARKER")]
+        ...     mf.tracks.append(mt)
+        >>> [(i, tick) for i, tick, _ in mf.merged_events()]
+        [(0, 0), (1, 48), (0, 96)]
+        '''
+        streams = []
+        for i, trk in enumerate(self.tracks):
+            trk._check_tick_index() # pylint: disable=protected-access
+            streams.append(zip(
+                [i] * len(trk.tick_index),
+                trk.tick_index,
+                [trk.events[position] for position in trk.tick_positions]))
+        return merge_event_streams(streams)
+
+    def get_notes(self):
+        '''
+        Return the notes of every parsed track, see :meth:`MidiTrack.get_notes`.
+        '''
+        return [trk.get_notes() for trk in self.tracks]
+
+    def get_tempo_map(self):
+        '''
+        Return a :class:`TempoMap` of the parsed `.tracks`.
+        '''
+        return TempoMap.from_events(
+            self.merged_events(),
+            self.ticks_per_quarter_note,
+            self.ticks_per_second)
+
+    def write(self, running_status=False):
         '''
         Write MIDI data as a file to the file opened with `.open()`.
+        Tracks are encoded and written one at a time.
+        With `running_status` the tracks that are encoded leave out
+        repeated status bytes, see :meth:`MidiEvent.write_to`.
         '''
-        self.file.write(self.writestr())
+        self.file.write(self.write_m_thd_str())
+        for trk in self.tracks:
+            self.file.write(trk.get_bytes(running_status))
 
-    def writestr(self):
+    def writestr(self, running_status=False):
         '''
         generate the midi data header and convert the list of
         midi_track objects in self_tracks into midi data and return it as a string_
         '''
-        midi_str = self.write_m_thd_str()
+        out = bytearray(self.write_m_thd_str())
         for trk in self.tracks:
-            midi_str = midi_str + trk.get_bytes()
-        return midi_str
+            trk.write_to(out, running_status)
+        return bytes(out)
 
     def write_m_thd_str(self):
         '''
@@ -1197,6 +1890,206 @@ class MidiFile(object):
         midi_str = midi_str + put_number(division, 2)
         return midi_str
 
+class TempoMap(object):
+    '''
+    Conversion between ticks and seconds, built once from the
+    `(tick, microseconds per quarter note)` of all SET_TEMPO events.
+
+    Between two tempo changes seconds grow linearly with ticks, so the
+    map only stores the tick, second and seconds per tick at every
+    change; conversions bisect those. Before the first change the
+    default tempo of 120 quarter notes per minute applies. When
+    `ticks_per_second` is given (SMPTE division) tempo changes do not
+    matter.
+
+    >>> tm = TempoMap(96, [(0, 500000), (192, 1000000)])
+    >>> tm.tick_to_seconds(96)
+    0.5
+    >>> tm.tick_to_seconds(288)
+    2.0
+    >>> tm.seconds_to_tick(2.0)
+    288.0
+    >>> tm.tempo_at(191), tm.tempo_at(192)
+    (500000, 1000000)
+    >>> TempoMap(ticks_per_second=100).tick_to_seconds(250)
+    2.5
+    '''
+    DEFAULT_TEMPO = 500000
+
+    def __init__(self, ticks_per_quarter_note=1024, tempo_changes=(),
+                 ticks_per_second=None):
+        self.ticks_per_quarter_note = ticks_per_quarter_note
+        self.ticks_per_second = ticks_per_second
+        self.ticks = array('L', [0])
+        self.seconds = array('d', [0.0])
+        self.tempos = array('L', [self.DEFAULT_TEMPO])
+        self._seconds_per_tick = array(
+            'd', [self._get_seconds_per_tick(self.DEFAULT_TEMPO)])
+        # stable sort, of several changes at one tick the last one counts
+        for tick, tempo in sorted(tempo_changes, key=lambda change: change[0]):
+            self._add_tempo_change(tick, tempo)
+
+    def _get_seconds_per_tick(self, tempo):
+        if self.ticks_per_second:
+            return 1.0 / self.ticks_per_second
+        # a tempo of 0 would make the map impossible to invert
+        return max(tempo, 1) / 1000000.0 / self.ticks_per_quarter_note
+
+    def _add_tempo_change(self, tick, tempo):
+        if tick != self.ticks[-1]:
+            self.seconds.append(self.tick_to_seconds(tick))
+            self.ticks.append(tick)
+            self.tempos.append(tempo)
+            self._seconds_per_tick.append(self._get_seconds_per_tick(tempo))
+        else:
+            self.tempos[-1] = tempo
+            self._seconds_per_tick[-1] = self._get_seconds_per_tick(tempo)
+
+    @classmethod
+    def from_events(cls, events, ticks_per_quarter_note=1024,
+                    ticks_per_second=None):
+        '''
+        Build the map from a stream of `(track_index, absolute_tick, event)`
+        as produced by :meth:`MidiFile.iter_events` or
+        :meth:`MidiFile.merged_events`.
+        '''
+        set_tempo = EVENT_KINDS.SET_TEMPO
+        tempo_changes = []
+        for _, tick, event in events:
+            if event.kind == set_tempo and len(event.data) == 3:
+                tempo_changes.append((tick, read_number(event.data, 0, 3)[0]))
+        return cls(ticks_per_quarter_note, tempo_changes, ticks_per_second)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def __repr__(self):
+        return "<TempoMap %d segments>" % len(self)
+
+    def tempo_at(self, tick):
+        '''
+        Return the tempo, in microseconds per quarter note, at `tick`.
+        '''
+        return self.tempos[bisect_right(self.ticks, tick) - 1]
+
+    def tick_to_seconds(self, tick):
+        '''
+        Return the time in seconds at which `tick` happens.
+        '''
+        i = bisect_right(self.ticks, tick) - 1
+        return self.seconds[i] + (tick - self.ticks[i]) * self._seconds_per_tick[i]
+
+    def seconds_to_tick(self, seconds):
+        '''
+        Return the (fractional) tick that happens at `seconds`.
+        '''
+        i = max(bisect_right(self.seconds, seconds) - 1, 0)
+        return self.ticks[i] + (seconds - self.seconds[i]) / self._seconds_per_tick[i]
+
+class VelocityPatcher(object):
+    '''
+    Make velocity, tempo and pitch adjusted copies of MIDI data without
+    re-encoding it.
+
+    The data is parsed once to find the byte offset of every note
+    velocity and pitch, per track, and of every SET_TEMPO value. A
+    variant is then a copy of the original data with only those bytes
+    overwritten; everything else, including running status, stays exactly as it was.
+
+    >>> mf = MidiFile()
+    >>> mt = MidiTrack(0)
+    >>> name = MidiEvent(mt, type_="SEQUENCE_TRACK_NAME")
+    >>> name.data = 'alto:'
+    >>> note = MidiEvent(mt, type_="NOTE_ON", channel=1)
+    >>> note.pitch, note.velocity = 60, 100
+    >>> mt.events = [DeltaTime(mt, time=0), name, DeltaTime(mt, time=0), note]
+    >>> mf.tracks.append(mt)
+    >>> patcher = VelocityPatcher(mf.writestr())
+    >>> patcher.track_names
+    [b'alto:']
+    >>> patched = MidiFile()
+    >>> patched.readstr(patcher.patch(10, {0: 30}))
+    >>> patched.tracks[0].events[3]
+    <MidiEvent NOTE_ON, t=None, track=0, channel=1, pitch=60, velocity=127>
+    >>> tempo = MidiEvent(mt, type_="SET_TEMPO")
+    >>> tempo.data = b'\\x07\\xa1\\x20'
+    >>> mt.events[:0] = [DeltaTime(mt, time=0), tempo]
+    >>> patched = MidiFile()
+    >>> patched.readstr(VelocityPatcher(mf.writestr()).patch(tempo_factor=1.25))
+    >>> patched.tracks[0].events[1]
+    <MidiEvent SET_TEMPO, t=None, track=0, channel=None, data=b'\\x06\\x1a\\x80'>
+    >>> patched = MidiFile()
+    >>> patched.readstr(VelocityPatcher(mf.writestr()).patch(semitones=-3))
+    >>> patched.tracks[0].events[5]
+    <MidiEvent NOTE_ON, t=None, track=0, channel=1, pitch=57, velocity=100>
+    '''
+    def __init__(self, midi_str):
+        self.midi_str = bytes(midi_str)
+        # per track: the first SEQUENCE_TRACK_NAME data (or None)
+        # and the positions of all NOTE_ON/NOTE_OFF velocity bytes
+        self.track_names = []
+        self.offsets = []
+        # positions of the pitch bytes, except on channel 10 (drums)
+        self.pitch_offsets = []
+        self.tempo_offsets = array('L')
+        buf = memoryview(self.midi_str)
+        num_tracks, pos = MidiFile().read_header(buf)
+        for i in range(num_tracks):
+            trk = MidiTrack(i)
+            pos, end = trk.read_chunk_header(buf, pos)
+            name = None
+            offsets = array('L')
+            pitch_offsets = array('L')
+            for _, _, event, next_pos in trk.iter_events_from(buf, pos, end):
+                if event.kind == _NOTE_ON or event.kind == _NOTE_OFF:
+                    # the velocity is the last byte of a note event,
+                    # the pitch the one before it
+                    offsets.append(next_pos - 1)
+                    if event.channel != 10:
+                        pitch_offsets.append(next_pos - 2)
+                elif event.kind == _SEQUENCE_TRACK_NAME and name is None:
+                    name = event.data
+                elif event.kind == _SET_TEMPO and len(event.data) == 3:
+                    # the tempo is the last 3 bytes of its event
+                    self.tempo_offsets.append(next_pos - 3)
+            self.track_names.append(name)
+            self.offsets.append(offsets)
+            self.pitch_offsets.append(pitch_offsets)
+            pos = end
+
+    def patch(self, velocity=0, track_velocities=None, tempo_factor=1.0, semitones=0):
+        '''
+        Return a copy of the data with `velocity` plus
+        `track_velocities[track_index]` added to every note velocity,
+        clamped to 0..127. Zero velocities (note offs) are left alone.
+        All tempos are made `tempo_factor` times as fast and all notes,
+        except drums, are shifted by `semitones`.
+        '''
+        if track_velocities is None:
+            track_velocities = {}
+        out = bytearray(self.midi_str)
+        if tempo_factor != 1.0:
+            for position in self.tempo_offsets:
+                out[position:position + 3] = scale_tempo_data(
+                    out[position:position + 3], tempo_factor)
+        if semitones != 0:
+            table = transpose_table(semitones)
+            for pitch_offsets in self.pitch_offsets:
+                for position in pitch_offsets:
+                    pitch = table[out[position]]
+                    if pitch == 0xFF:
+                        raise transpose_error(out[position], semitones)
+                    out[position] = pitch
+        for i, offsets in enumerate(self.offsets):
+            offset = velocity + track_velocities.get(i, 0)
+            if offset == 0:
+                continue
+            table = bytes([0]) + bytes(
+                min(max(value + offset, 0), 127) for value in range(1, 256))
+            for position in offsets:
+                out[position] = table[out[position]]
+        return bytes(out)
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -347,6 +347,8 @@ class SongTab:
         # remove files
         for file_ in chain(
                 self._data_path.glob("{}-*.midi".format(self.name)),
+                self._data_path.glob("{}-*.midi.cache".format(self.name)),
+                self._data_path.glob("{}-*.midi.*.partial".format(self.name)),
                 self._data_path.glob("{}-*.png".format(self.name)),
                 self._data_path.glob("{}-*.pdf".format(self.name))):
             file_.unlink()